@@ -0,0 +1,53 @@
+"""add layer_catalogs
+
+Revision ID: a3c5e1f08b2d
+Revises: 71c52d9a8344
+Create Date: 2025-07-08 10:12:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "a3c5e1f08b2d"
+down_revision: Union[str, None] = "71c52d9a8344"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Per-layer schema and statistics, computed once at ingest
+    op.create_table(
+        "layer_catalogs",
+        sa.Column("layer_id", sa.String(length=12), nullable=False),
+        sa.Column("layer_version", sa.String(length=12), nullable=False),
+        sa.Column("driver", sa.String(), nullable=True),
+        sa.Column("crs", sa.String(), nullable=True),
+        sa.Column("feature_count", sa.Integer(), nullable=True),
+        sa.Column("fields", postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.Column(
+            "column_stats", postgresql.JSONB(astext_type=sa.Text()), nullable=True
+        ),
+        sa.Column(
+            "sample_rows", postgresql.JSONB(astext_type=sa.Text()), nullable=False
+        ),
+        sa.Column(
+            "computed_at",
+            sa.TIMESTAMP(timezone=True),
+            server_default=sa.text("CURRENT_TIMESTAMP"),
+            nullable=True,
+        ),
+        sa.ForeignKeyConstraint(
+            ["layer_id"],
+            ["map_layers.layer_id"],
+        ),
+        sa.PrimaryKeyConstraint("layer_id"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("layer_catalogs")
@@ -1,4 +1,4 @@
-import { useState, useEffect, useCallback } from "react"
+import { useState, useEffect, useCallback, type UIEvent } from "react"
 import { Card, CardContent } from "@/components/ui/card"
 import { Dialog, DialogContent, DialogHeader, DialogTitle } from "@/components/ui/dialog"
 import { MapLayer } from "@/lib/types"
@@ -27,8 +27,11 @@ export default function AttributeTable({ layer, isOpen, onClose }: AttributeTabl
     data: [],
   })
   const [duration, setDuration] = useState(0);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [lastQuery, setLastQuery] = useState("");
+  const [querySignature, setQuerySignature] = useState<string | null>(null);
 
-  const fetchLayerData = useCallback(async (query: string) => {
+  const fetchLayerData = useCallback(async (query: string, cursor?: string) => {
     setIsLoading(true)
     try {
       const response = await fetch(`/api/layer/${layer.id}/query`, {
@@ -38,7 +41,8 @@ export default function AttributeTable({ layer, isOpen, onClose }: AttributeTabl
         },
         body: JSON.stringify({
           natural_language_query: query,
-          max_n_rows: 100
+          max_n_rows: 100,
+          cursor: cursor ?? null
         }),
       })
 
@@ -49,12 +53,16 @@ export default function AttributeTable({ layer, isOpen, onClose }: AttributeTabl
       const result = await response.json()
       setSqlQuery(result.query)
       setDuration(result.duration_ms);
+      setNextCursor(result.next_cursor ?? null);
+      setQuerySignature(result.query_signature ?? null);
+      setLastQuery(query);
 
-      // Use headers and result arrays directly from the response
-      setData({
+      // Use headers and result arrays directly from the response,
+      // appending when this is a continuation page
+      setData(prev => ({
         columns: result.headers,
-        data: result.result
-      })
+        data: cursor ? [...prev.data, ...result.result] : result.result
+      }))
 
     } catch (error) {
       console.error('Error fetching layer data:', error)
@@ -77,6 +85,26 @@ export default function AttributeTable({ layer, isOpen, onClose }: AttributeTabl
     return () => clearTimeout(timer)
   }, [inputText, layer, fetchLayerData])
 
+  // Fetch the next page when scrolled near the bottom of the table
+  const handleScroll = useCallback((e: UIEvent<HTMLDivElement>) => {
+    const el = e.currentTarget;
+    if (!nextCursor || isLoading) return;
+    if (el.scrollHeight - el.scrollTop - el.clientHeight < 200) {
+      fetchLayerData(lastQuery, nextCursor)
+    }
+  }, [nextCursor, isLoading, lastQuery, fetchLayerData])
+
+  // Export links carry the query itself, so they keep working however long
+  // the table stays open
+  const exportUrl = (format: string) => {
+    const params = new URLSearchParams({
+      query: sqlQuery,
+      signature: querySignature ?? "",
+      format,
+    })
+    return `/api/layer/${layer.id}/export?${params}`
+  }
+
   // Handle escape key to close dialog
   useEffect(() => {
     const handleKeyDown = (e: KeyboardEvent) => {
@@ -124,7 +152,7 @@ export default function AttributeTable({ layer, isOpen, onClose }: AttributeTabl
           </Card>
 
           {/* Table display with sticky header */}
-          <div className="border border-border rounded-md flex-1 overflow-y-auto">
+          <div className="border border-border rounded-md flex-1 overflow-y-auto" onScroll={handleScroll}>
             <table className={`w-full text-sm relative ${isLoading ? "animate-pulse" : ""}`}>
               <thead>
                 <tr className="border-b border-border">
@@ -150,7 +178,13 @@ export default function AttributeTable({ layer, isOpen, onClose }: AttributeTabl
           </div>
         </div>
 
-        {/* TODO: add download CSV */}
+        {querySignature && (
+          <div className="flex gap-3 text-xs text-muted-foreground">
+            Download all rows:
+            <a className="underline" href={exportUrl("geoparquet")}>GeoParquet</a>
+            <a className="underline" href={exportUrl("arrow")}>Arrow</a>
+          </div>
+        )}
       </DialogContent>
     </Dialog>
   )
@@ -0,0 +1,279 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import logging
+import os
+import secrets
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from osgeo import gdal
+from redis import Redis
+
+from src.structures import get_async_db_connection
+from src.utils import get_async_s3_client, get_bucket_name
+
+logger = logging.getLogger(__name__)
+
+redis = Redis(
+    host=os.environ["REDIS_HOST"],
+    port=int(os.environ["REDIS_PORT"]),
+    decode_responses=True,
+)
+
+# GDAL conversions are CPU and memory heavy, so only a few run at once and
+# the rest queue up behind them
+COG_MAX_WORKERS = int(os.environ.get("COG_MAX_WORKERS", "2"))
+# held while a worker generates a layer's COG, so other uvicorn workers wait
+# for it instead of converting the same raster again. The holder renews it
+# while the job runs, so a crashed worker only blocks others for this long
+COG_JOB_LOCK_SECONDS = 60
+COG_JOB_LOCK_RENEW_SECONDS = COG_JOB_LOCK_SECONDS / 3
+
+# only touch the lock while it still holds our token, so a job that outlived
+# its lock can't release or extend one another worker has since taken
+_release_lock = redis.register_script(
+    """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("del", KEYS[1])
+    end
+    return 0
+    """
+)
+_renew_lock = redis.register_script(
+    """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("expire", KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+)
+
+
+class CogGenerationError(Exception):
+    pass
+
+
+def build_cog(
+    layer_id: str, local_input_file: str, metadata: dict, temp_dir: str
+) -> str:
+    """Convert a raster into a Cloud Optimized GeoTIFF, returning its path.
+
+    Palette expansion and reprojection to EPSG:3857 are chained as VRTs, so
+    they are evaluated block by block while the COG is written and the COG
+    is the only full size raster that touches disk. Blocking.
+    """
+    local_cog_file = os.path.join(temp_dir, f"layer_{layer_id}.cog.tif")
+
+    src = gdal.Open(local_input_file)
+    if src is None:
+        logger.error(f"Failed to open raster for {layer_id}: {gdal.GetLastErrorMsg()}")
+        raise CogGenerationError(f"Failed to process raster info for layer {layer_id}.")
+
+    source = local_input_file
+    needs_color_ramp_suffix = False
+    if src.RasterCount == 1:
+        if src.GetRasterBand(1).GetColorTable() is not None:
+            # Expand paletted rasters to RGB before warping, so bilinear
+            # resampling blends colors rather than palette indexes
+            expanded_vrt = os.path.join(temp_dir, f"layer_{layer_id}_rgb.vrt")
+            if gdal.Translate(expanded_vrt, src, format="VRT", rgbExpand="rgb"):
+                source = expanded_vrt
+                logger.info(f"Expanded single band to RGB for layer {layer_id}")
+        elif "raster_value_stats_b1" in metadata:
+            # Use the existing raster_value_stats_b1 from metadata
+            needs_color_ramp_suffix = True
+            logger.info(f"Using existing raster_value_stats_b1 for layer {layer_id}")
+    src = None
+
+    # Reproject to EPSG:3857 lazily, warping on every core as blocks are read
+    warped_vrt = os.path.join(temp_dir, f"layer_{layer_id}_3857.vrt")
+    logger.info(f"Warping layer {layer_id} to EPSG:3857")
+    if gdal.Warp(
+        warped_vrt,
+        source,
+        format="VRT",
+        dstSRS="EPSG:3857",
+        resampleAlg="bilinear",
+        multithread=True,
+        warpOptions=["NUM_THREADS=ALL_CPUS"],
+    ):
+        source = warped_vrt
+    else:
+        logger.warning(
+            f"gdalwarp failed for layer {layer_id}: {gdal.GetLastErrorMsg()}. "
+            "Using original file for COG creation."
+        )
+
+    creation_options = ["BLOCKSIZE=256", "OVERVIEWS=AUTO", "NUM_THREADS=ALL_CPUS"]
+    if needs_color_ramp_suffix:
+        output_type = gdal.GDT_Float32
+        creation_options.append("COMPRESS=LZW")
+    else:
+        output_type = gdal.GDT_Unknown  # keep the source type
+        creation_options.extend(["COMPRESS=JPEG", "QUALITY=85"])
+
+    if not gdal.Translate(
+        local_cog_file,
+        source,
+        format="COG",
+        outputType=output_type,
+        creationOptions=creation_options,
+    ):
+        error = gdal.GetLastErrorMsg()
+        logger.error(f"COG generation failed for layer {layer_id}: {error}")
+        raise CogGenerationError(
+            f"COG generation failed: {error or 'Unknown GDAL error'}"
+        )
+
+    return local_cog_file
+
+
+async def _keep_lock(lock_key: str, token: str):
+    while True:
+        await asyncio.sleep(COG_JOB_LOCK_RENEW_SECONDS)
+        if not _renew_lock(keys=[lock_key], args=[token, COG_JOB_LOCK_SECONDS]):
+            logger.warning(f"Lost {lock_key} while generating its COG")
+            return
+
+
+class CogJobQueue:
+    """Runs COG generation in the background, at most one job per layer.
+
+    Concurrent requests for the same layer share one job in this process,
+    and a Redis lock makes other workers wait for it rather than starting
+    their own conversion.
+    """
+
+    def __init__(self, max_workers: int):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="cog"
+        )
+        self._inflight: dict[str, asyncio.Task] = {}
+
+    def ensure(self, layer_id: str) -> asyncio.Task:
+        """Start the COG job for a layer unless one is already running.
+
+        The task resolves to the layer's cog_key.
+        """
+        task = self._inflight.get(layer_id)
+        if task is None:
+            task = asyncio.ensure_future(self._run(layer_id))
+            self._inflight[layer_id] = task
+            task.add_done_callback(lambda t: self._finished(layer_id, t))
+        return task
+
+    def _finished(self, layer_id: str, task: asyncio.Task):
+        self._inflight.pop(layer_id, None)
+        # jobs started at upload have nobody awaiting them
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                f"COG job for layer {layer_id} failed: {task.exception()}",
+            )
+
+    async def _run(self, layer_id: str) -> str:
+        lock_key = f"cog_job:{layer_id}"
+        while True:
+            layer = await _fetch_layer(layer_id)
+            metadata = json.loads(layer["metadata"] or "{}")
+            if metadata.get("cog_key"):
+                return metadata["cog_key"]
+
+            token = secrets.token_hex(16)
+            if redis.set(lock_key, token, nx=True, ex=COG_JOB_LOCK_SECONDS):
+                renewal = asyncio.ensure_future(_keep_lock(lock_key, token))
+                try:
+                    return await self._generate(layer_id, layer["s3_key"], metadata)
+                finally:
+                    renewal.cancel()
+                    _release_lock(keys=[lock_key], args=[token])
+
+            # another worker is converting this layer
+            await asyncio.sleep(1)
+
+    async def _generate(self, layer_id: str, s3_key: str, metadata: dict) -> str:
+        bucket_name = get_bucket_name()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # Download the raster file
+            file_extension = os.path.splitext(s3_key)[1]
+            local_input_file = os.path.join(
+                temp_dir, f"layer_{layer_id}{file_extension}"
+            )
+            s3 = await get_async_s3_client()
+            await s3.download_file(bucket_name, s3_key, local_input_file)
+
+            local_cog_file = await asyncio.get_running_loop().run_in_executor(
+                self.executor,
+                build_cog,
+                layer_id,
+                local_input_file,
+                metadata,
+                temp_dir,
+            )
+
+            # Upload the COG file to S3
+            cog_key = f"cog/layer/{layer_id}.cog.tif"
+            await s3.upload_file(local_cog_file, bucket_name, cog_key)
+            logger.info(f"Uploaded COG to s3://{bucket_name}/{cog_key}")
+
+        # merge rather than overwrite, metadata may have changed meanwhile
+        async with get_async_db_connection() as conn:
+            await conn.execute(
+                """
+                UPDATE map_layers
+                SET metadata = COALESCE(metadata, '{}'::jsonb) || jsonb_build_object('cog_key', $1::text)
+                WHERE layer_id = $2
+                """,
+                cog_key,
+                layer_id,
+            )
+        logger.info(f"Updated metadata for layer {layer_id} with cog_key")
+        return cog_key
+
+
+async def _fetch_layer(layer_id: str):
+    async with get_async_db_connection() as conn:
+        layer = await conn.fetchrow(
+            """
+            SELECT s3_key, metadata
+            FROM map_layers
+            WHERE layer_id = $1
+            """,
+            layer_id,
+        )
+    if not layer:
+        raise KeyError(f"Layer {layer_id} not found")
+    return layer
+
+
+cog_jobs = CogJobQueue(max_workers=COG_MAX_WORKERS)
+
+
+def start_cog_job(layer_id: str) -> asyncio.Task:
+    return cog_jobs.ensure(layer_id)
+
+
+async def wait_for_cog(layer_id: str, timeout: float) -> Optional[str]:
+    """cog_key once the layer's COG exists, or None if still pending after timeout."""
+    task = cog_jobs.ensure(layer_id)
+    try:
+        # shield so a request giving up doesn't cancel the shared job
+        return await asyncio.wait_for(asyncio.shield(task), timeout=timeout)
+    except asyncio.TimeoutError:
+        return None
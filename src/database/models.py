@@ -183,6 +183,26 @@ class MapLayer(Base):
     )
     styles = relationship("LayerStyle", back_populates="layer")
     map_layer_styles = relationship("MapLayerStyle", back_populates="layer")
+    catalog = relationship("LayerCatalog", back_populates="layer", uselist=False)
+
+
+class LayerCatalog(Base):
+    __tablename__ = "layer_catalogs"
+
+    layer_id = Column(String(12), ForeignKey("map_layers.layer_id"), primary_key=True)
+    layer_version = Column(String(12), nullable=False)  # layer file it describes
+    driver = Column(String)
+    crs = Column(String)
+    feature_count = Column(Integer)
+    fields = Column(JSONB, nullable=False)  # [{name, type}] as reported by fiona
+    column_stats = Column(JSONB)  # [{name, type, min, max, distinct_count, ...}]
+    sample_rows = Column(JSONB, nullable=False)  # first features' properties
+    computed_at = Column(
+        TIMESTAMP(timezone=True), server_default=func.current_timestamp()
+    )
+
+    # Relationships
+    layer = relationship("MapLayer", back_populates="catalog")
 
 
 class LayerStyle(Base):
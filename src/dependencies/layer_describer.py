@@ -15,16 +15,13 @@
 
 import asyncpg
 import csv
-import fiona
 import io
 import json
-import os
-import tempfile
 from abc import ABC, abstractmethod
 from functools import lru_cache
 from typing import Dict, Any, List
 
-from src.utils import get_async_s3_client, get_bucket_name
+from src.layer_catalog import get_layer_catalog
 from src.structures import get_async_db_connection
 
 
@@ -176,97 +173,102 @@ class DefaultLayerDescriber(LayerDescriber):
             f"Last Edited: {str(layer_data['last_edited']) if layer_data['last_edited'] else 'Unknown'}"
         )
 
-        bucket_name = get_bucket_name()
-
-        with tempfile.TemporaryDirectory() as temp_dir:
-            s3_key = layer_data["s3_key"]
-            file_extension = os.path.splitext(s3_key)[1]
+        # schema, CRS and sample rows come from the catalog computed at ingest
+        catalog = await get_layer_catalog(
+            layer_id, layer_data["s3_key"], layer_data["last_edited"]
+        )
+        feature_count = catalog["feature_count"]
 
-            local_input_file = os.path.join(
-                temp_dir, f"layer_{layer_id}_input{file_extension}"
+        markdown_content.append("\n## Geographic Extent\n")
+        if layer_data["bounds"]:
+            markdown_content.append(
+                f"Dataset Bounds: {layer_data['bounds'][0]:.6f},{layer_data['bounds'][1]:.6f},{layer_data['bounds'][2]:.6f},{layer_data['bounds'][3]:.6f}"
             )
 
-            s3 = await get_async_s3_client()
-            await s3.download_file(bucket_name, s3_key, local_input_file)
+        markdown_content.append("\n## Schema Information\n")
 
-            with fiona.open(local_input_file) as src:
-                feature_count = len(src)
-                features = list(src)
-                schema = src.schema
-                crs = src.crs
+        markdown_content.append(f"CRS: {catalog['crs'] or 'Unknown'}")
+        markdown_content.append(f"Driver: {catalog['driver']}")
+        markdown_content.append("\n### Attribute Fields\n")
 
-                markdown_content.append("\n## Geographic Extent\n")
-                if layer_data["bounds"]:
-                    markdown_content.append(
-                        f"Dataset Bounds: {layer_data['bounds'][0]:.6f},{layer_data['bounds'][1]:.6f},{layer_data['bounds'][2]:.6f},{layer_data['bounds'][3]:.6f}"
-                    )
+        if catalog["fields"]:
+            fields_by_type = {}
+            for field in catalog["fields"]:
+                if field["type"] not in fields_by_type:
+                    fields_by_type[field["type"]] = []
+                fields_by_type[field["type"]].append(field["name"])
 
-                markdown_content.append("\n## Schema Information\n")
-
-                async with get_async_db_connection() as conn:
-                    await conn.execute(
-                        """
-                        UPDATE map_layers
-                        SET feature_count = $1
-                        WHERE layer_id = $2
-                        """,
-                        feature_count,
-                        layer_id,
-                    )
+            for field_type in sorted(fields_by_type.keys()):
+                markdown_content.append(f"\n#### {field_type}\n")
+                for field_name in sorted(fields_by_type[field_type]):
+                    markdown_content.append(f"{field_name}")
+        else:
+            markdown_content.append("No attribute fields found.")
 
-                markdown_content.append(f"CRS: {crs.to_string() if crs else 'Unknown'}")
-                markdown_content.append(f"Driver: {src.driver}")
-                markdown_content.append("\n### Attribute Fields\n")
+        features_with_attrs = catalog["sample_rows"]
 
-                if "properties" in schema and schema["properties"]:
-                    fields_by_type = {}
-                    for field_name, field_type in schema["properties"].items():
-                        if field_type not in fields_by_type:
-                            fields_by_type[field_type] = []
-                        fields_by_type[field_type].append(field_name)
+        if features_with_attrs:
+            all_fieldnames = set()
+            for feature_props in features_with_attrs:
+                all_fieldnames.update(feature_props.keys())
 
-                    for field_type in sorted(fields_by_type.keys()):
-                        markdown_content.append(f"\n#### {field_type}\n")
-                        for field_name in sorted(fields_by_type[field_type]):
-                            markdown_content.append(f"{field_name}")
-                else:
-                    markdown_content.append("No attribute fields found.")
+            fieldnames = sorted(list(all_fieldnames))
 
-                features_with_attrs = []
-                for i, feature in enumerate(features[:10]):
-                    features_with_attrs.append(feature["properties"])
+            markdown_content.append("\n## Sampled Features Attribute Table\n")
 
-                if features_with_attrs:
-                    all_fieldnames = set()
-                    for feature_props in features_with_attrs:
-                        all_fieldnames.update(feature_props.keys())
+            markdown_content.append(
+                f"\nRandomly sampled {len(features_with_attrs)} of {feature_count} features for this table."
+            )
 
-                    fieldnames = sorted(list(all_fieldnames))
+            csv_output = io.StringIO()
+            writer = csv.DictWriter(csv_output, fieldnames=fieldnames)
+            writer.writeheader()
 
-                    markdown_content.append("\n## Sampled Features Attribute Table\n")
+            for feature_props in features_with_attrs:
+                filtered_props = {}
+                for k in fieldnames:
+                    value = feature_props.get(k, "")
+                    filtered_props[k] = value
+                writer.writerow(filtered_props)
 
-                    markdown_content.append(
-                        f"\nRandomly sampled {len(features_with_attrs)} of {feature_count} features for this table."
-                    )
+            markdown_content.append("```csv")
+            markdown_content.append(csv_output.getvalue())
+            markdown_content.append("```")
 
-                    csv_output = io.StringIO()
-                    writer = csv.DictWriter(csv_output, fieldnames=fieldnames)
-                    writer.writeheader()
+        if catalog["column_stats"]:
+            markdown_content.append("\n## Column Statistics\n")
 
-                    for feature_props in features_with_attrs:
-                        filtered_props = {}
-                        for k in fieldnames:
-                            value = feature_props.get(k, "")
-                            filtered_props[k] = value
-                        writer.writerow(filtered_props)
+            csv_output = io.StringIO()
+            writer = csv.writer(csv_output)
+            writer.writerow(
+                ["column", "type", "min", "max", "distinct_count", "null_count"]
+            )
+            for stat in catalog["column_stats"]:
+                writer.writerow(
+                    [
+                        stat["name"],
+                        stat["type"],
+                        # long strings are noise for the model
+                        _truncate(stat["min"]),
+                        _truncate(stat["max"]),
+                        stat["distinct_count"],
+                        stat["null_count"],
+                    ]
+                )
 
-                    markdown_content.append("```csv")
-                    markdown_content.append(csv_output.getvalue())
-                    markdown_content.append("```")
+            markdown_content.append("```csv")
+            markdown_content.append(csv_output.getvalue())
+            markdown_content.append("```")
 
         return markdown_content
 
 
+def _truncate(value, max_length: int = 40):
+    if isinstance(value, str) and len(value) > max_length:
+        return value[: max_length - 3] + "..."
+    return value
+
+
 @lru_cache(maxsize=1)
 def get_layer_describer() -> LayerDescriber:
     return DefaultLayerDescriber()
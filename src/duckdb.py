@@ -14,10 +14,23 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import concurrent.futures
+import datetime
+import decimal
+import json
+import math
+import os
+import queue
+import threading
 import time
+import uuid
 import duckdb
-import json
 import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack
+from typing import AsyncIterator, Optional
+import pyarrow as pa
+import pyarrow.parquet as pq
 from fastapi import HTTPException, status
 
 from src.fs_lru import layer_cache
@@ -60,6 +73,114 @@ DUCKDB_RESERVED_KEYWORDS = {
 }
 
 
+class DuckDBConnectionPool:
+    """Warm in-memory DuckDB connections with the spatial extension loaded.
+
+    Connections are handed to one executor thread at a time. Layers are
+    attached per query and detached afterwards, so a returned connection
+    holds no layer state. Each connection is its own database, so
+    memory_limit and threads cap every query individually.
+
+    The configuration is locked once the limits are applied, and a
+    connection whose catalog or settings differ from a fresh one on release
+    (a table or view some caller created, say) is closed rather than reused.
+    """
+
+    def __init__(
+        self,
+        max_idle: int = 8,
+        memory_limit: str = "1GB",
+        threads: int = 2,
+    ):
+        self.max_idle = max_idle
+        self.memory_limit = memory_limit
+        self.threads = threads
+        self._idle = queue.LifoQueue()
+        self._clean_state = None
+
+    def _connect(self) -> duckdb.DuckDBPyConnection:
+        con = duckdb.connect(
+            ":memory:",
+            config={"memory_limit": self.memory_limit, "threads": self.threads},
+        )
+        # Extensions are cached locally
+        con.install_extension("spatial")
+        con.load_extension("spatial")
+        return con
+
+    def _new_connection(self) -> duckdb.DuckDBPyConnection:
+        con = self._connect()
+        # no SET/RESET from user SQL can loosen the limits from here on
+        con.execute("SET lock_configuration = true")
+        if self._clean_state is None:
+            self._clean_state = self._state(con)
+        return con
+
+    @staticmethod
+    def _state(con: duckdb.DuckDBPyConnection) -> tuple:
+        """Catalog entries and settings a caller could leave behind."""
+        return (
+            con.execute(
+                "SELECT database_name FROM duckdb_databases() ORDER BY ALL"
+            ).fetchall(),
+            con.execute(
+                """
+                SELECT database_name, schema_name, table_name FROM duckdb_tables()
+                UNION ALL
+                SELECT database_name, schema_name, view_name FROM duckdb_views()
+                WHERE NOT internal
+                UNION ALL
+                SELECT database_name, schema_name, sequence_name FROM duckdb_sequences()
+                UNION ALL
+                SELECT database_name, schema_name, type_name FROM duckdb_types()
+                WHERE NOT internal
+                ORDER BY ALL
+                """
+            ).fetchall(),
+            con.execute(
+                "SELECT name, value FROM duckdb_settings() ORDER BY name"
+            ).fetchall(),
+        )
+
+    def _is_clean(self, con: duckdb.DuckDBPyConnection) -> bool:
+        try:
+            return self._state(con) == self._clean_state
+        except duckdb.Error:
+            return False
+
+    def acquire(self) -> duckdb.DuckDBPyConnection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._new_connection()
+
+    def release(self, con: duckdb.DuckDBPyConnection, discard: bool = False):
+        if discard or self._idle.qsize() >= self.max_idle or not self._is_clean(con):
+            con.close()
+        else:
+            self._idle.put(con)
+
+
+# Queries run on their own bounded executor so runaway SQL can only ever
+# occupy DUCKDB_MAX_WORKERS threads, never the loop's default executor
+DUCKDB_MAX_WORKERS = int(os.environ.get("DUCKDB_MAX_WORKERS", "4"))
+# Exports block their thread until the client has read the stream, so they
+# get separate workers and slow downloads can't starve interactive queries
+DUCKDB_EXPORT_MAX_WORKERS = int(os.environ.get("DUCKDB_EXPORT_MAX_WORKERS", "2"))
+
+duckdb_pool = DuckDBConnectionPool(
+    max_idle=DUCKDB_MAX_WORKERS + DUCKDB_EXPORT_MAX_WORKERS,
+    memory_limit=os.environ.get("DUCKDB_MEMORY_LIMIT", "1GB"),
+    threads=int(os.environ.get("DUCKDB_THREADS", "2")),
+)
+duckdb_executor = ThreadPoolExecutor(
+    max_workers=DUCKDB_MAX_WORKERS, thread_name_prefix="duckdb"
+)
+duckdb_export_executor = ThreadPoolExecutor(
+    max_workers=DUCKDB_EXPORT_MAX_WORKERS, thread_name_prefix="duckdb-export"
+)
+
+
 def quoted_col_for(name: str) -> str:
     if not name:
         return '"{}"'.format(name)
@@ -75,46 +196,337 @@ def quoted_col_for(name: str) -> str:
     return name
 
 
-async def execute_duckdb_query(
-    sql_query: str, layer_id: str, max_n_rows: int = 25, timeout: int = 10
+def _json_value(value):
+    """Convert a DuckDB Python value into something JSON serializable."""
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, float):
+        return None if math.isnan(value) or math.isinf(value) else value
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, dict):
+        return {str(k): _json_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_value(v) for v in value]
+    return str(value)
+
+
+def referenced_layer_ids(sql_query: str, layer_ids: list[str]) -> list[str]:
+    """Layer IDs from layer_ids that sql_query actually mentions as a name."""
+    return [
+        layer_id
+        for layer_id in dict.fromkeys(layer_ids)
+        if re.search(rf"(?<![\w$]){re.escape(layer_id)}(?![\w$])", sql_query, re.I)
+    ]
+
+
+async def _run_with_layers(
+    sql_query: str,
+    layer_ids: list[str],
+    func,
+    timeout: int,
+    executor: ThreadPoolExecutor = duckdb_executor,
 ):
-    start_time = time.time()
+    """Call func(con) on a pooled connection with the layers sql_query names
+    mounted, in the DuckDB executor.
+
+    Every referenced layer is attached read-only from its cached DuckDB file
+    and exposed as a view called by its layer ID, so a single query can join
+    across layers. Layers that are passed but never referenced are not
+    fetched or attached.
+    """
     cache = layer_cache()
-    # Acquire cached geopackage path in async context
-    async with cache.layer_filename(layer_id) as gpkg_path:
-
-        def query_func():
-            con = duckdb.connect(":memory:")
-            # Extensions are cached locally
-            con.install_extension("spatial")
-            con.load_extension("spatial")
-
-            # Create table from cached parquet file
-            con.execute(f"""
-                CREATE OR REPLACE TABLE {layer_id} AS
-                SELECT * FROM ST_Read('{gpkg_path}');
-            """)
-
-            result = con.execute(sql_query).fetchdf().head(max_n_rows)
-            result_json = result.to_json(orient="values")
-            headers = result.columns.tolist()
-
-            return {
-                "status": "success",
-                "duration_ms": 1000 * (time.time() - start_time),
-                "result": json.loads(result_json),
-                "headers": headers,
-                "row_count": len(result),
-                "query": sql_query,
-            }
+    # a query that names no layer (SELECT 1) still runs, just with nothing mounted
+    mounted_ids = referenced_layer_ids(sql_query, layer_ids)
 
-        loop = asyncio.get_running_loop()
-        try:
-            return await asyncio.wait_for(
-                loop.run_in_executor(None, query_func), timeout=timeout
+    async with AsyncExitStack() as stack:
+        # Acquire cached DuckDB database paths in async context; each stays
+        # locked in the cache until the query finishes
+        db_paths = {}
+        for layer_id in mounted_ids:
+            db_paths[layer_id] = await stack.enter_async_context(
+                cache.layer_filename(layer_id, "DuckDB")
             )
+
+        # lets the event loop interrupt the connection the query runs on
+        running: dict[str, duckdb.DuckDBPyConnection] = {}
+        stopping = threading.Event()
+
+        def run():
+            con = duckdb_pool.acquire()
+            running["con"] = con
+            healthy = False
+            interrupted = False
+            attached = []
+            try:
+                if stopping.is_set():
+                    raise duckdb.InterruptException("query stopped")
+                try:
+                    for i, (layer_id, db_path) in enumerate(db_paths.items()):
+                        alias = f"layer_db_{i}"
+                        con.execute(f"ATTACH '{db_path}' AS {alias} (READ_ONLY)")
+                        attached.append((layer_id, alias))
+                        con.execute(f"""
+                            CREATE OR REPLACE TEMP VIEW {layer_id} AS
+                            SELECT * FROM {alias}.main.layer;
+                        """)
+
+                    return func(con)
+                except duckdb.InterruptException:
+                    interrupted = True
+                    raise
+                finally:
+                    for layer_id, alias in attached:
+                        con.execute(f"DROP VIEW IF EXISTS {layer_id}")
+                        con.execute(f"DETACH {alias}")
+                    healthy = True
+            finally:
+                running.pop("con", None)
+                # an interrupted connection may be mid-statement, never reuse it
+                duckdb_pool.release(
+                    con, discard=not healthy or interrupted or stopping.is_set()
+                )
+
+        job = executor.submit(run)
+        future = asyncio.wrap_future(job)
+
+        async def stop_thread():
+            stopping.set()
+            # still queued behind busy workers, so it never has to run
+            if job.cancel():
+                return
+            # the executor thread keeps going unless DuckDB is told to stop.
+            # An interrupt only reaches a running statement, so keep sending
+            # one until the thread gives the connection back; the layer
+            # files stay locked until then
+            while not future.done():
+                con = running.get("con")
+                if con is not None:
+                    con.interrupt()
+                await asyncio.wait({future}, timeout=0.1)
+            if not future.cancelled():
+                future.exception()
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
         except asyncio.TimeoutError:
+            await stop_thread()
             raise HTTPException(
                 status_code=status.HTTP_504_GATEWAY_TIMEOUT,
                 detail=f"DuckDB query timed out after {timeout} seconds",
             )
+        except asyncio.CancelledError:
+            # e.g. a losing query_layer candidate or a disconnected export
+            await stop_thread()
+            raise
+
+
+async def execute_duckdb_query(
+    sql_query: str,
+    layer_ids: list[str],
+    max_n_rows: int = 25,
+    timeout: int = 10,
+    offset: int = 0,
+):
+    """Run sql_query against one or more layers, returning one page of rows.
+
+    The row cap is pushed down into DuckDB as a LIMIT/OFFSET on the query's
+    relation, so only the requested page is materialised. One extra row is
+    fetched to tell whether another page follows (`has_more`).
+    """
+    start_time = time.time()
+
+    def query_func(con):
+        relation = con.sql(sql_query)
+        if relation is None:
+            # statement without a result set
+            return [], []
+        return relation.columns, relation.limit(max_n_rows + 1, offset).fetchall()
+
+    headers, rows = await _run_with_layers(sql_query, layer_ids, query_func, timeout)
+
+    has_more = len(rows) > max_n_rows
+    rows = rows[:max_n_rows]
+
+    return {
+        "status": "success",
+        "duration_ms": 1000 * (time.time() - start_time),
+        "result": [[_json_value(value) for value in row] for row in rows],
+        "headers": headers,
+        "row_count": len(rows),
+        "offset": offset,
+        "has_more": has_more,
+        "query": sql_query,
+    }
+
+
+async def validate_duckdb_query(
+    sql_query: str, layer_ids: list[str], timeout: int = 5
+) -> Optional[str]:
+    """Bind and plan sql_query with EXPLAIN without running it.
+
+    Returns None when the query is valid, otherwise DuckDB's error message.
+    """
+
+    def explain_func(con):
+        try:
+            con.execute(f"EXPLAIN {sql_query}")
+        except duckdb.Error as e:
+            return str(e)
+        return None
+
+    return await _run_with_layers(sql_query, layer_ids, explain_func, timeout)
+
+
+# media type and file extension of each export format
+EXPORT_FORMATS = {
+    "arrow": ("application/vnd.apache.arrow.stream", "arrow"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "geoparquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+class _ChunkSink:
+    """Write-only file object that buffers bytes until they are taken."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def _quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+async def stream_duckdb_export(
+    sql_query: str,
+    layer_ids: list[str],
+    format: str,
+    crs: Optional[dict] = None,
+    batch_rows: int = 64 * 1024,
+    timeout: int = 300,
+) -> AsyncIterator[bytes]:
+    """Stream the full result of sql_query as Arrow IPC, Parquet or GeoParquet.
+
+    Record batches go straight from DuckDB's batch reader into the writer,
+    and the encoded bytes are yielded as each batch is written, so memory
+    stays bounded by a few batches whatever the result size. GEOMETRY
+    columns are written as WKB; for GeoParquet they are described in the
+    `geo` metadata, with crs as PROJJSON when given.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"unsupported export format {format}")
+
+    loop = asyncio.get_running_loop()
+    # bounded, so a slow client applies backpressure to the DuckDB thread
+    chunks: asyncio.Queue = asyncio.Queue(maxsize=8)
+    stop = threading.Event()
+
+    def emit(chunk: bytes):
+        if not chunk:
+            return
+        put = asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop)
+        while True:
+            try:
+                put.result(timeout=1)
+                return
+            except concurrent.futures.TimeoutError:
+                if stop.is_set():
+                    put.cancel()
+                    raise duckdb.InterruptException("export cancelled")
+
+    def produce(con):
+        relation = con.sql(sql_query)
+        if relation is None:
+            raise ValueError("export requires a query that returns rows")
+
+        geometry_columns = [
+            name
+            for name, column_type in zip(relation.columns, relation.types)
+            if str(column_type) == "GEOMETRY"
+        ]
+        if geometry_columns:
+            relation = relation.project(
+                ", ".join(
+                    f"ST_AsWKB({_quote_identifier(name)}) AS {_quote_identifier(name)}"
+                    if name in geometry_columns
+                    else _quote_identifier(name)
+                    for name in relation.columns
+                )
+            )
+
+        reader = relation.fetch_arrow_reader(batch_rows)
+        schema = reader.schema
+        if format == "geoparquet" and geometry_columns:
+            geo = {
+                "version": "1.1.0",
+                "primary_column": geometry_columns[0],
+                "columns": {
+                    name: {"encoding": "WKB", "geometry_types": []}
+                    | ({"crs": crs} if crs else {})
+                    for name in geometry_columns
+                },
+            }
+            schema = schema.with_metadata({b"geo": json.dumps(geo).encode()})
+
+        sink = _ChunkSink()
+        if format == "arrow":
+            writer = pa.ipc.new_stream(sink, schema)
+        else:
+            writer = pq.ParquetWriter(sink, schema, compression="zstd")
+
+        for batch in reader:
+            if stop.is_set():
+                raise duckdb.InterruptException("export cancelled")
+            writer.write_batch(batch)
+            emit(sink.take())
+        writer.close()
+        emit(sink.take())
+
+    task = asyncio.create_task(
+        _run_with_layers(
+            sql_query, layer_ids, produce, timeout, executor=duckdb_export_executor
+        )
+    )
+    try:
+        while True:
+            getter = asyncio.ensure_future(chunks.get())
+            await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                yield getter.result()
+                continue
+            getter.cancel()
+            break
+
+        # the producer finished, drain what it left and surface its errors
+        while not chunks.empty():
+            yield chunks.get_nowait()
+        task.result()
+    finally:
+        # e.g. the client disconnected; on cancellation the task interrupts
+        # the DuckDB thread and waits for it to let go of the layers
+        stop.set()
+        if not task.done():
+            task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
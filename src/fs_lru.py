@@ -14,170 +14,853 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import hashlib
+import mmap
+import shutil
+import sqlite3
 import tempfile
+import threading
+import time
 from collections import OrderedDict
+from typing import Optional
 import asyncio
-from contextlib import asynccontextmanager
+import duckdb
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from src.cog import start_cog_job
 from src.structures import get_async_db_connection
 from src.utils import get_async_s3_client, get_bucket_name
 
 
+class _MemoryIndex:
+    """LRU bookkeeping for a cache directory owned by a single process.
+
+    Locks are reference counted pins. Pinned keys are taken out of the LRU
+    list entirely, so the head of the list is always the next victim and
+    eviction never has to skip over files that are in use.
+    """
+
+    def __init__(self):
+        self.sizes = {}  # key -> file size, pinned or not
+        self.lru = OrderedDict()  # unpinned keys only, least recent first
+        self.pins = {}  # key -> number of holders
+        self.total = 0
+
+    def transaction(self):
+        return nullcontext()
+
+    def get_size(self, key) -> Optional[int]:
+        return self.sizes.get(key)
+
+    def put(self, key, size: int):
+        self.total += size - self.sizes.get(key, 0)
+        self.sizes[key] = size
+        if key not in self.pins:
+            self.lru[key] = None
+            self.lru.move_to_end(key)
+
+    def touch(self, key):
+        if key in self.lru:
+            self.lru.move_to_end(key)
+
+    def remove(self, key) -> Optional[int]:
+        size = self.sizes.pop(key, None)
+        if size is not None:
+            self.total -= size
+        self.lru.pop(key, None)
+        return size
+
+    def total_size(self) -> int:
+        return self.total
+
+    def lru_unlocked(self) -> Optional[str]:
+        return next(iter(self.lru), None)
+
+    def keys_with_prefix(self, prefix: str) -> list[str]:
+        return [key for key in self.sizes if key.startswith(prefix)]
+
+    def lock(self, key):
+        self.pins[key] = self.pins.get(key, 0) + 1
+        self.lru.pop(key, None)
+
+    def unlock(self, key):
+        count = self.pins.get(key, 0) - 1
+        if count > 0:
+            self.pins[key] = count
+            return
+        self.pins.pop(key, None)
+        if key in self.sizes:
+            # just released, so it is the most recently used
+            self.lru[key] = None
+
+    def is_locked(self, key) -> bool:
+        return key in self.pins
+
+    def prune_dead_locks(self) -> bool:
+        return False
+
+
+class _SharedIndex:
+    """LRU bookkeeping shared by every process using the same cache directory.
+
+    Entries and locks live in a SQLite database (WAL mode) next to the cached
+    files, so uvicorn workers on one node see one coherent byte budget and
+    never evict a file another worker is reading. Locks are leases recorded
+    per pid, which lets a surviving worker reclaim leases from a dead one.
+    """
+
+    def __init__(self, db_path: str):
+        self.pid = os.getpid()
+        self._lock = threading.RLock()
+        self._depth = 0
+        self.db = sqlite3.connect(
+            db_path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+            CREATE TABLE IF NOT EXISTS leases (
+                key TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (key, pid)
+            );
+            """
+        )
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the database write lock up front, so the file
+        # operation done inside the block and its index update are atomic with
+        # respect to other workers
+        with self._lock:
+            self._depth += 1
+            if self._depth == 1:
+                self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                if self._depth == 1:
+                    self.db.execute("ROLLBACK")
+                raise
+            else:
+                if self._depth == 1:
+                    self.db.execute("COMMIT")
+            finally:
+                self._depth -= 1
+
+    def get_size(self, key) -> Optional[int]:
+        with self._lock:
+            row = self.db.execute(
+                "SELECT size FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, size: int):
+        with self.transaction():
+            self.db.execute(
+                """
+                INSERT INTO entries (key, size, last_access) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE
+                SET size = excluded.size, last_access = excluded.last_access
+                """,
+                (key, size, time.time()),
+            )
+
+    def touch(self, key):
+        with self.transaction():
+            self.db.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+
+    def remove(self, key) -> Optional[int]:
+        with self.transaction():
+            size = self.get_size(key)
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        return size
+
+    def total_size(self) -> int:
+        with self._lock:
+            return self.db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()[0]
+
+    def lru_unlocked(self) -> Optional[str]:
+        with self._lock:
+            row = self.db.execute(
+                """
+                SELECT key FROM entries
+                WHERE key NOT IN (SELECT key FROM leases)
+                ORDER BY last_access
+                LIMIT 1
+                """
+            ).fetchone()
+        return row[0] if row else None
+
+    def keys_with_prefix(self, prefix: str) -> list[str]:
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT key FROM entries WHERE substr(key, 1, ?) = ?",
+                (len(prefix), prefix),
+            ).fetchall()
+        return [key for (key,) in rows]
+
+    def lock(self, key):
+        with self.transaction():
+            self.db.execute(
+                """
+                INSERT INTO leases (key, pid, count) VALUES (?, ?, 1)
+                ON CONFLICT (key, pid) DO UPDATE SET count = count + 1
+                """,
+                (key, self.pid),
+            )
+
+    def unlock(self, key):
+        with self.transaction():
+            self.db.execute(
+                "UPDATE leases SET count = count - 1 WHERE key = ? AND pid = ?",
+                (key, self.pid),
+            )
+            self.db.execute("DELETE FROM leases WHERE count <= 0")
+
+    def is_locked(self, key) -> bool:
+        with self._lock:
+            row = self.db.execute(
+                "SELECT 1 FROM leases WHERE key = ? LIMIT 1", (key,)
+            ).fetchone()
+        return row is not None
+
+    def prune_dead_locks(self) -> bool:
+        """Drop leases held by processes that no longer exist."""
+        with self.transaction():
+            pids = [
+                pid
+                for (pid,) in self.db.execute("SELECT DISTINCT pid FROM leases")
+                if not _pid_alive(pid)
+            ]
+            self.db.executemany(
+                "DELETE FROM leases WHERE pid = ?", [(pid,) for pid in pids]
+            )
+        return bool(pids)
+
+    def reconcile(self, cache_dir: str):
+        """Make the index agree with the files actually present on disk."""
+        with self.transaction():
+            # listed under the write lock, so no other worker adds or evicts
+            # a file between the listing and the index update
+            sizes = _file_sizes(cache_dir)
+            indexed = {key for (key,) in self.db.execute("SELECT key FROM entries")}
+            self.db.executemany(
+                "DELETE FROM entries WHERE key = ?",
+                [(key,) for key in indexed - sizes.keys()],
+            )
+            now = time.time()
+            self.db.executemany(
+                "INSERT INTO entries (key, size, last_access) VALUES (?, ?, ?)",
+                [(key, sizes[key], now) for key in sizes.keys() - indexed],
+            )
+
+
+def _file_sizes(cache_dir: str) -> dict[str, int]:
+    sizes = {}
+    for fn in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, fn)
+        if fn.startswith(".") or not os.path.isfile(path):
+            continue
+        sizes[fn] = os.path.getsize(path)
+    return sizes
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
 class FileCache:
-    def __init__(self, cache_dir, max_size):
+    def __init__(
+        self,
+        cache_dir,
+        max_size,
+        shared: bool = False,
+        max_age: Optional[float] = None,
+        min_free_bytes: int = 0,
+    ):
+        """LRU cache of files in cache_dir, bounded to max_size bytes.
+
+        With shared=True the index is kept in SQLite inside cache_dir, so
+        several processes can use the same directory with one budget.
+        Entries older than max_age seconds are treated as missing, and files
+        are also evicted while the disk has less than min_free_bytes free.
+        """
         os.makedirs(cache_dir, exist_ok=True)
         self.cache_dir, self.max_size = cache_dir, max_size
-        self.cache = OrderedDict()  # key -> file size
-        self.locked_keys = set()
-        self.total = 0
-        for fn in os.listdir(cache_dir):
-            path = os.path.join(cache_dir, fn)
-            size = os.path.getsize(path)
-            self.cache[fn] = size
-            self.total += size
+        self.max_age, self.min_free_bytes = max_age, min_free_bytes
+        # scratch space on the same filesystem, so finished files can be
+        # adopted into the cache with an atomic rename instead of a copy
+        self.tmp_dir = os.path.join(cache_dir, ".tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+        if shared:
+            self.index = _SharedIndex(os.path.join(cache_dir, ".index.sqlite3"))
+            self.index.prune_dead_locks()
+            self.index.reconcile(cache_dir)
+        else:
+            self.index = _MemoryIndex()
+            for fn, size in _file_sizes(cache_dir).items():
+                self.index.put(fn, size)
+
+    def _over_budget(self) -> bool:
+        if self.index.total_size() > self.max_size:
+            return True
+        if self.min_free_bytes:
+            return shutil.disk_usage(self.cache_dir).free < self.min_free_bytes
+        return False
+
+    def _expired(self, key) -> bool:
+        if not self.max_age:
+            return False
+        try:
+            mtime = os.path.getmtime(os.path.join(self.cache_dir, key))
+        except FileNotFoundError:
+            return True
+        return time.time() - mtime > self.max_age
 
     def _evict(self):
-        while self.total > self.max_size:
-            for key in list(self.cache.keys()):
-                if key not in self.locked_keys:
-                    size = self.cache.pop(key)
-                    os.remove(os.path.join(self.cache_dir, key))
-                    self.total -= size
-                    break
-            else:
-                break
+        while True:
+            with self.index.transaction():
+                if not self._over_budget():
+                    return
+                key = self.index.lru_unlocked()
+                if key is not None:
+                    self.index.remove(key)
+                    try:
+                        os.remove(os.path.join(self.cache_dir, key))
+                    except FileNotFoundError:
+                        pass
+                    continue
+            # everything left is locked; retry once if a dead process held it
+            if not self.index.prune_dead_locks():
+                return
 
     def set(self, key, data: bytes):
-        path = os.path.join(self.cache_dir, key)
-        with open(path, "wb") as f:
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        with os.fdopen(fd, "wb") as f:
             f.write(data)
-        size = os.path.getsize(path)
-        if key in self.cache:
-            self.total -= self.cache.pop(key)
-        self.cache[key] = size
-        self.total += size
-        self._evict()
+        self.set_from_path(key, tmp_path)
 
-    def get(self, key) -> bytes:
-        if key not in self.cache:
-            raise KeyError(f"Key {key} not found in cache")
+    def set_from_path(self, key, src_path: str):
+        """Move a finished file into the cache under key.
+
+        src_path should live under tmp_dir so the move is an atomic rename;
+        readers never observe a partially written cache file.
+        """
         path = os.path.join(self.cache_dir, key)
-        self.cache.move_to_end(key)
+        with self.index.transaction():
+            try:
+                os.replace(src_path, path)
+            except OSError:
+                # different filesystem, fall back to copy + delete
+                shutil.move(src_path, path)
+            self.index.put(key, os.path.getsize(path))
+        self._evict()
+
+    def get(self, key) -> memoryview:
+        """Read-only view of the cached file, backed by mmap.
+
+        Pages are loaded lazily by the kernel, so large files are never
+        fully copied into the Python heap.
+        """
+        path = self.get_path(key)
         with open(path, "rb") as f:
-            return f.read()
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"")
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
 
     def has(self, key) -> bool:
-        return key in self.cache
+        if self.index.get_size(key) is None:
+            return False
+        if self._expired(key):
+            # someone still holding the file keeps it alive until unlock
+            return not self.remove(key)
+        return True
 
     def get_path(self, key) -> str:
-        if key not in self.cache:
+        if not self.has(key):
             raise KeyError(f"Key {key} not found in cache")
-        self.cache.move_to_end(key)
+        self.index.touch(key)
         return os.path.join(self.cache_dir, key)
 
+    def keys_with_prefix(self, prefix: str) -> list[str]:
+        return self.index.keys_with_prefix(prefix)
+
+    def remove(self, key) -> bool:
+        """Delete key from the cache unless it is locked. Returns if removed."""
+        with self.index.transaction():
+            if self.index.is_locked(key):
+                return False
+            self.index.remove(key)
+            try:
+                os.remove(os.path.join(self.cache_dir, key))
+            except FileNotFoundError:
+                pass
+        return True
+
     def lock(self, key):
-        self.locked_keys.add(key)
+        self.index.lock(key)
 
     def unlock(self, key):
-        self.locked_keys.discard(key)
+        self.index.unlock(key)
+
+
+class MemoryCache:
+    """Small in-process LRU of bytes, for hot entries too small to be worth
+    a trip to disk. Entries larger than max_entry_size are never stored."""
+
+    def __init__(self, max_size: int, max_entry_size: int, max_age=None):
+        self.max_size, self.max_entry_size = max_size, max_entry_size
+        self.max_age = max_age
+        self.cache = OrderedDict()  # key -> (inserted_at, data)
+        self.total = 0
+
+    def get(self, key) -> Optional[bytes]:
+        item = self.cache.get(key)
+        if item is None:
+            return None
+        inserted_at, data = item
+        if self.max_age and time.time() - inserted_at > self.max_age:
+            self.remove(key)
+            return None
+        self.cache.move_to_end(key)
+        return data
+
+    def set(self, key, data: bytes):
+        if len(data) > self.max_entry_size or len(data) > self.max_size:
+            return
+        self.remove(key)
+        self.cache[key] = (time.time(), data)
+        self.total += len(data)
+        while self.total > self.max_size:
+            _, (_, evicted) = self.cache.popitem(last=False)
+            self.total -= len(evicted)
+
+    def remove(self, key):
+        item = self.cache.pop(key, None)
+        if item is not None:
+            self.total -= len(item[1])
+
+
+class SegmentedMemoryCache:
+    """In-process SLRU of bytes.
+
+    New entries land in a probation segment and are promoted to the
+    protected segment on their second hit, so a one-off sweep through a
+    large file can't flush the blocks every client keeps asking for.
+    """
+
+    def __init__(self, max_size: int, protected_fraction: float = 0.8):
+        self.max_size = max_size
+        self.max_protected = int(max_size * protected_fraction)
+        self.probation = OrderedDict()  # key -> data, least recent first
+        self.protected = OrderedDict()
+        self.probation_total = self.protected_total = 0
+
+    def get(self, key) -> Optional[bytes]:
+        data = self.protected.get(key)
+        if data is not None:
+            self.protected.move_to_end(key)
+            return data
+        data = self.probation.pop(key, None)
+        if data is None:
+            return None
+        self.probation_total -= len(data)
+        self.protected[key] = data
+        self.protected_total += len(data)
+        # demote the coldest protected entries back to probation
+        while self.protected_total > self.max_protected and len(self.protected) > 1:
+            demoted_key, demoted = self.protected.popitem(last=False)
+            self.protected_total -= len(demoted)
+            self.probation[demoted_key] = demoted
+            self.probation_total += len(demoted)
+        self._evict()
+        return data
+
+    def set(self, key, data: bytes):
+        if len(data) > self.max_size or key in self.protected:
+            return
+        previous = self.probation.pop(key, None)
+        if previous is not None:
+            self.probation_total -= len(previous)
+        self.probation[key] = data
+        self.probation_total += len(data)
+        self._evict()
+
+    def remove_prefix(self, prefix: str):
+        for key in [key for key in self.probation if key.startswith(prefix)]:
+            self.probation_total -= len(self.probation.pop(key))
+        for key in [key for key in self.protected if key.startswith(prefix)]:
+            self.protected_total -= len(self.protected.pop(key))
+
+    def _evict(self):
+        while self.probation_total + self.protected_total > self.max_size:
+            if self.probation:
+                _, evicted = self.probation.popitem(last=False)
+                self.probation_total -= len(evicted)
+            else:
+                _, evicted = self.protected.popitem(last=False)
+                self.protected_total -= len(evicted)
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, got {value!r}") from None
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    if value.strip().lower() in ("1", "true", "yes", "on"):
+        return True
+    if value.strip().lower() in ("0", "false", "no", "off"):
+        return False
+    raise ValueError(f"{name} must be true or false, got {value!r}")
 
 
 class LayerCache:
     def __init__(self):
+        """Layer files cached on local disk.
+
+        Configured from the environment:
+            LAYER_CACHE_DIR                     directory for the disk tier (/cache)
+            LAYER_CACHE_MAX_BYTES               disk tier budget (128 MiB)
+            LAYER_CACHE_MAX_AGE_SECONDS         max entry age, 0 disables (0)
+            LAYER_CACHE_MIN_FREE_BYTES          evict while disk free space is below (0)
+            LAYER_CACHE_SHARED_INDEX            share the disk index across processes
+                                                (on when WEB_CONCURRENCY > 1)
+        """
+        max_age = _env_int("LAYER_CACHE_MAX_AGE_SECONDS", 0) or None
+        # uvicorn forks WEB_CONCURRENCY workers that all share the cache dir
+        shared = _env_bool("LAYER_CACHE_SHARED_INDEX", False) or (
+            _env_int("WEB_CONCURRENCY", 1) > 1
+        )
         self.file_cache = FileCache(
-            cache_dir="/cache", max_size=1024 * 1024 * 128
-        )  # 128 MiB
+            cache_dir=os.environ.get("LAYER_CACHE_DIR") or "/cache",
+            max_size=_env_int("LAYER_CACHE_MAX_BYTES", 1024 * 1024 * 128),
+            shared=shared,
+            max_age=max_age,
+            min_free_bytes=_env_int("LAYER_CACHE_MIN_FREE_BYTES", 0),
+        )
+        # cache_key -> task fetching that layer, so concurrent misses on the
+        # same layer share one download + conversion instead of racing
+        self._inflight: dict[str, asyncio.Task] = {}
 
     @asynccontextmanager
-    async def layer_filename(self, layer_id: str):
-        cache_key = f"{layer_id}.gpkg"
-
-        await self.bytes_for_layer(layer_id, "GeoPackage")
-
+    async def layer_filename(self, layer_id: str, format: str = "GeoPackage"):
+        cache_key, s3_key = await self._lookup(layer_id, _extension_for(format))
+
+        # a locked entry never expires, so drop a stale copy before our own
+        # lock would keep it alive
+        self.file_cache.has(cache_key)
+        # lock before populating, so neither this process nor another worker
+        # can evict the file between it landing in the cache and us using it
         self.file_cache.lock(cache_key)
         try:
+            await self._ensure_cached(layer_id, cache_key, s3_key)
             yield self.file_cache.get_path(cache_key)
         finally:
             self.file_cache.unlock(cache_key)
 
-    async def bytes_for_layer(self, layer_id: str, format: str = "GeoPackage") -> bytes:
-        cache_key = f"{layer_id}.gpkg"
+    async def bytes_for_layer(
+        self, layer_id: str, format: str = "GeoPackage"
+    ) -> memoryview:
+        cache_key, s3_key = await self._lookup(layer_id, _extension_for(format))
+        await self._ensure_cached(layer_id, cache_key, s3_key)
+        return self.file_cache.get(cache_key)
 
-        try:
-            return self.file_cache.get(cache_key)
-        except (KeyError, FileNotFoundError):
-            # not cached yet or missing file, proceed to fetch
-            pass
+    async def cache_key_for_layer(self, layer_id: str, extension: str = "gpkg") -> str:
+        cache_key, _ = await self._lookup(layer_id, extension)
+        return cache_key
 
+    async def _lookup(self, layer_id: str, extension: str) -> tuple[str, str]:
+        """Resolve (cache_key, s3_key) for the current version of a layer."""
         async with get_async_db_connection() as conn:
             layer = await conn.fetchrow(
                 """
-                SELECT layer_id, name, type, metadata, bounds, geometry_type,
-                    created_on, last_edited, feature_count, s3_key
+                SELECT s3_key, last_edited
                 FROM map_layers
                 WHERE layer_id = $1
                 """,
                 layer_id,
             )
 
-            if not layer:
-                raise KeyError(f"Layer {layer_id} not found")
+        if not layer or not layer["s3_key"]:
+            raise KeyError(f"Layer {layer_id} not found")
+
+        version = layer_version(layer["s3_key"], layer["last_edited"])
+        return f"{layer_id}-{version}.{extension}", layer["s3_key"]
+
+    async def _ensure_cached(self, layer_id: str, cache_key: str, s3_key: str):
+        if self.file_cache.has(cache_key) and os.path.exists(
+            os.path.join(self.file_cache.cache_dir, cache_key)
+        ):
+            return
+
+        task = self._inflight.get(cache_key)
+        if task is None:
+            if cache_key.endswith(".parquet"):
+                build = self._build_parquet(layer_id, cache_key)
+            elif cache_key.endswith(".duckdb"):
+                build = self._build_duckdb(layer_id, cache_key)
+            elif cache_key.endswith(".cog.tif"):
+                build = self._fetch_cog(layer_id, cache_key)
+            else:
+                build = self._fetch_layer(layer_id, cache_key, s3_key)
+            task = asyncio.ensure_future(build)
+            self._inflight[cache_key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(cache_key, None))
 
-            # Check if the layer is associated with any maps via the layers array
-            # Order by created_on DESC to get the most recently created map first
-            await conn.fetch(
-                """
-                SELECT id, title, description, owner_uuid
-                FROM user_mundiai_maps
-                WHERE $1 = ANY(layers) AND soft_deleted_at IS NULL
-                ORDER BY created_on DESC
-                """,
-                layer_id,
-            )
+        # shield so one cancelled waiter doesn't abort the fetch for the others
+        await asyncio.shield(task)
+
+    async def _fetch_layer(self, layer_id: str, cache_key: str, s3_key: str):
+        bucket_name = get_bucket_name()
 
-            bucket_name = get_bucket_name()
+        with tempfile.TemporaryDirectory(dir=self.file_cache.tmp_dir) as temp_dir:
+            file_extension = os.path.splitext(s3_key)[1]
+            s3 = await get_async_s3_client()
 
-            with tempfile.TemporaryDirectory() as temp_dir:
-                s3_key = layer["s3_key"]
-                file_extension = os.path.splitext(s3_key)[1]
+            cached_output_gpkg = os.path.join(temp_dir, f"{layer_id}.gpkg")
 
+            if file_extension.lower() == ".gpkg":
+                # already a GeoPackage, download straight into place
+                await s3.download_file(bucket_name, s3_key, cached_output_gpkg)
+            else:
                 local_input_file = os.path.join(
                     temp_dir, f"{layer_id}_input{file_extension}"
                 )
-
-                s3 = await get_async_s3_client()
                 await s3.download_file(bucket_name, s3_key, local_input_file)
 
-                cached_output_gpkg = os.path.join(temp_dir, f"{layer_id}.gpkg")
-
-                if format != "GeoPackage":
-                    raise TypeError("only GeoPackage supported in bytes_for_layer")
-
-                if file_extension.lower() == ".gpkg":
-                    with (
-                        open(local_input_file, "rb") as src,
-                        open(cached_output_gpkg, "wb") as dst,
-                    ):
-                        dst.write(src.read())
-                else:
-                    ogr_cmd = [
-                        "ogr2ogr",
-                        "-f",
-                        "GPKG",
-                        cached_output_gpkg,
-                        local_input_file,
-                    ]
-                    process = await asyncio.create_subprocess_exec(*ogr_cmd)
-                    await process.wait()
-                    if process.returncode != 0:
-                        raise Exception(
-                            f"ogr2ogr command failed with exit code {process.returncode}"
+                ogr_cmd = [
+                    "ogr2ogr",
+                    "-f",
+                    "GPKG",
+                    cached_output_gpkg,
+                    local_input_file,
+                ]
+                process = await asyncio.create_subprocess_exec(*ogr_cmd)
+                await process.wait()
+                if process.returncode != 0:
+                    raise Exception(
+                        f"ogr2ogr command failed with exit code {process.returncode}"
+                    )
+
+            self.file_cache.set_from_path(cache_key, cached_output_gpkg)
+
+    async def _fetch_cog(self, layer_id: str, cache_key: str):
+        """Download a raster layer's Cloud Optimized GeoTIFF.
+
+        Waits for the background COG job first if it hasn't finished yet.
+        """
+        cog_key = await start_cog_job(layer_id)
+        with tempfile.TemporaryDirectory(dir=self.file_cache.tmp_dir) as temp_dir:
+            local_cog_file = os.path.join(temp_dir, f"{layer_id}.cog.tif")
+            s3 = await get_async_s3_client()
+            await s3.download_file(get_bucket_name(), cog_key, local_cog_file)
+            self.file_cache.set_from_path(cache_key, local_cog_file)
+
+    async def _build_parquet(self, layer_id: str, cache_key: str):
+        """Derive a GeoParquet copy of the layer from its cached GeoPackage.
+
+        Columnar scans over Parquet are much cheaper for DuckDB than going
+        through ST_Read on the GeoPackage for every query.
+        """
+        async with self.layer_filename(layer_id, "GeoPackage") as gpkg_path:
+            with tempfile.TemporaryDirectory(dir=self.file_cache.tmp_dir) as temp_dir:
+                parquet_path = os.path.join(temp_dir, f"{layer_id}.parquet")
+
+                def convert():
+                    con = _spatial_connection(":memory:")
+                    try:
+                        # GEOMETRY columns get GeoParquet metadata on write
+                        con.execute(
+                            f"""
+                            COPY (SELECT * FROM ST_Read('{gpkg_path}'))
+                            TO '{parquet_path}' (FORMAT PARQUET, COMPRESSION ZSTD)
+                            """
                         )
+                    finally:
+                        con.close()
+
+                await asyncio.get_running_loop().run_in_executor(None, convert)
+                self.file_cache.set_from_path(cache_key, parquet_path)
+
+    async def _build_duckdb(self, layer_id: str, cache_key: str):
+        """Materialise the layer once into a DuckDB database file.
+
+        The file holds a single table named `layer`; queries ATTACH it read
+        only, so repeated queries skip copying the layer entirely.
+        """
+        async with self.layer_filename(layer_id, "GeoParquet") as parquet_path:
+            with tempfile.TemporaryDirectory(dir=self.file_cache.tmp_dir) as temp_dir:
+                db_path = os.path.join(temp_dir, f"{layer_id}.duckdb")
+
+                def convert():
+                    con = _spatial_connection(db_path)
+                    try:
+                        con.execute(
+                            f"""
+                            CREATE TABLE layer AS
+                            SELECT * FROM read_parquet('{parquet_path}')
+                            """
+                        )
+                    finally:
+                        con.close()
 
-                with open(cached_output_gpkg, "rb") as f:
-                    data = f.read()
-                self.file_cache.set(cache_key, data)
+                await asyncio.get_running_loop().run_in_executor(None, convert)
+                self.file_cache.set_from_path(cache_key, db_path)
+
+
+class BlockCache:
+    def __init__(self):
+        """Block-aligned cache of byte ranges of remote objects (COGs, PMTiles).
+
+        Ranges are split into fixed size blocks, so overlapping or repeated
+        reads of headers, directories and IFDs are served locally whatever
+        exact offsets clients ask for. Blocks sit in an SLRU in RAM, backed
+        by an LRU on disk.
+
+        Configured from the environment:
+            RANGE_CACHE_BLOCK_BYTES       block size (64 KiB)
+            RANGE_CACHE_MEMORY_MAX_BYTES  RAM tier budget, 0 disables (64 MiB)
+            RANGE_CACHE_MAX_BYTES         disk tier budget, 0 disables (256 MiB)
+            RANGE_CACHE_DIR               directory for the disk tier
+                                          (LAYER_CACHE_DIR/ranges)
+        """
+        self.block_size = _env_int("RANGE_CACHE_BLOCK_BYTES", 64 * 1024)
+        self.memory_cache = SegmentedMemoryCache(
+            max_size=_env_int("RANGE_CACHE_MEMORY_MAX_BYTES", 64 * 1024 * 1024)
+        )
+        max_disk = _env_int("RANGE_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+        self.file_cache = None
+        if max_disk:
+            self.file_cache = FileCache(
+                cache_dir=os.environ.get("RANGE_CACHE_DIR")
+                or os.path.join(
+                    os.environ.get("LAYER_CACHE_DIR") or "/cache", "ranges"
+                ),
+                max_size=max_disk,
+                shared=_env_int("WEB_CONCURRENCY", 1) > 1,
+            )
+
+    async def read(self, object_id: str, size: int, start: int, end: int, fetch):
+        """Bytes start..end (inclusive) of an object of the given size.
+
+        object_id must change whenever the object's content does. Missing
+        blocks are fetched with `await fetch(start, end)`, one call per run
+        of consecutive missing blocks.
+        """
+        first, last = start // self.block_size, end // self.block_size
+        blocks = {}
+        missing = []
+        for index in range(first, last + 1):
+            data = self._get_block(object_id, index)
+            if data is None:
+                missing.append(index)
+            else:
+                blocks[index] = data
+
+        runs = []
+        for index in missing:
+            if runs and runs[-1][1] == index - 1:
+                runs[-1][1] = index
+            else:
+                runs.append([index, index])
+        fetched = await asyncio.gather(
+            *(
+                fetch(
+                    run_first * self.block_size,
+                    min((run_last + 1) * self.block_size, size) - 1,
+                )
+                for run_first, run_last in runs
+            )
+        )
+        for (run_first, run_last), data in zip(runs, fetched):
+            for index in range(run_first, run_last + 1):
+                offset = (index - run_first) * self.block_size
+                blocks[index] = data[offset : offset + self.block_size]
+                self._put_block(object_id, index, blocks[index])
+
+        joined = b"".join(blocks[index] for index in range(first, last + 1))
+        offset = first * self.block_size
+        return joined[start - offset : end - offset + 1]
+
+    def invalidate(self, object_id: str):
+        """Drop every cached block of object_id."""
+        prefix = f"{object_id}-"
+        self.memory_cache.remove_prefix(prefix)
+        if self.file_cache is not None:
+            for key in self.file_cache.keys_with_prefix(prefix):
+                self.file_cache.remove(key)
+
+    def _get_block(self, object_id: str, index: int) -> Optional[bytes]:
+        key = f"{object_id}-{index}"
+        data = self.memory_cache.get(key)
+        if data is not None or self.file_cache is None:
+            return data
+        try:
+            data = self.file_cache.get(key).tobytes()
+        except (KeyError, FileNotFoundError):
+            return None
+        self.memory_cache.set(key, data)
+        return data
+
+    def _put_block(self, object_id: str, index: int, data: bytes):
+        key = f"{object_id}-{index}"
+        self.memory_cache.set(key, data)
+        if self.file_cache is not None:
+            self.file_cache.set(key, data)
+
+
+def _extension_for(format: str) -> str:
+    if format == "GeoPackage":
+        return "gpkg"
+    if format == "GeoParquet":
+        return "parquet"
+    if format == "DuckDB":
+        return "duckdb"
+    if format == "COG":
+        return "cog.tif"
+    raise TypeError(f"unsupported layer cache format {format}")
 
-        return self.file_cache.get(cache_key)
+
+def _spatial_connection(database: str) -> duckdb.DuckDBPyConnection:
+    con = duckdb.connect(database)
+    # Extensions are cached locally
+    con.install_extension("spatial")
+    con.load_extension("spatial")
+    return con
+
+
+def layer_version(s3_key: str, last_edited) -> str:
+    """Short content version for a layer, changes whenever it is rewritten."""
+    stamp = last_edited.isoformat() if last_edited else ""
+    return hashlib.sha1(f"{s3_key}:{stamp}".encode()).hexdigest()[:12]
 
 
 cache_singleton = LayerCache()
@@ -185,3 +868,10 @@ cache_singleton = LayerCache()
 
 def layer_cache() -> LayerCache:
     return cache_singleton
+
+
+block_cache_singleton = BlockCache()
+
+
+def block_cache() -> BlockCache:
+    return block_cache_singleton
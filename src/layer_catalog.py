@@ -0,0 +1,214 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import itertools
+import json
+import logging
+import math
+from typing import Any, Dict, Optional
+
+import fiona
+
+from src.duckdb import execute_duckdb_query
+from src.fs_lru import layer_cache, layer_version
+from src.structures import get_async_db_connection
+
+logger = logging.getLogger(__name__)
+
+# Per-layer schema and statistics, computed once when a vector layer is
+# ingested so describing it never has to download the file again
+SAMPLE_ROWS = 10
+
+# layer_id -> catalog build in progress, so an ingest and concurrent
+# describe misses on the same layer share one refresh
+_catalog_refreshes: dict[str, asyncio.Task] = {}
+
+
+def _json_safe(value):
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, float):
+        # JSONB has no NaN/Infinity
+        return None if math.isnan(value) or math.isinf(value) else value
+    return str(value)
+
+
+def read_vector_catalog(path: str) -> Dict[str, Any]:
+    """Schema, CRS and sample rows of a vector file, as fiona sees them."""
+    with fiona.open(path) as src:
+        properties = src.schema.get("properties") or {}
+        sample_rows = [
+            {k: _json_safe(v) for k, v in dict(feature["properties"]).items()}
+            for feature in itertools.islice(src, SAMPLE_ROWS)
+        ]
+        return {
+            "driver": src.driver,
+            "crs": src.crs.to_string() if src.crs else None,
+            "feature_count": len(src),
+            "fields": [
+                {"name": name, "type": field_type}
+                for name, field_type in properties.items()
+            ],
+            "sample_rows": sample_rows,
+        }
+
+
+async def compute_column_stats(layer_id: str) -> list[Dict[str, Any]]:
+    """Per-column min/max, distinct and null counts from DuckDB's SUMMARIZE."""
+    result = await execute_duckdb_query(
+        f"SUMMARIZE SELECT COLUMNS(c -> c <> 'geom') FROM {layer_id}",
+        [layer_id],
+        max_n_rows=10_000,
+        timeout=120,
+    )
+    stats = []
+    for row in result["result"]:
+        row = dict(zip(result["headers"], row))
+        null_fraction = (row["null_percentage"] or 0) / 100
+        stats.append(
+            {
+                "name": row["column_name"],
+                "type": row["column_type"],
+                "min": row["min"],
+                "max": row["max"],
+                "distinct_count": row["approx_unique"],
+                "null_count": round(row["count"] * null_fraction),
+            }
+        )
+    return stats
+
+
+async def refresh_layer_catalog(
+    layer_id: str, local_path: Optional[str] = None
+) -> Dict[str, Any]:
+    """(Re)compute and store the catalog for a vector layer.
+
+    local_path skips the layer cache when the caller still has the uploaded
+    file; otherwise the cached GeoPackage the column stats also read is used.
+    """
+    async with get_async_db_connection() as conn:
+        layer = await conn.fetchrow(
+            """
+            SELECT s3_key, last_edited
+            FROM map_layers
+            WHERE layer_id = $1
+            """,
+            layer_id,
+        )
+    if not layer or not layer["s3_key"]:
+        raise KeyError(f"Layer {layer_id} not found")
+
+    loop = asyncio.get_running_loop()
+    if local_path is not None:
+        catalog = await loop.run_in_executor(None, read_vector_catalog, local_path)
+    else:
+        async with layer_cache().layer_filename(layer_id) as gpkg_path:
+            catalog = await loop.run_in_executor(None, read_vector_catalog, gpkg_path)
+
+    # statistics are a nice to have, the schema alone is enough to describe
+    try:
+        catalog["column_stats"] = await compute_column_stats(layer_id)
+    except Exception as e:
+        logger.warning("Could not compute column stats for %s: %s", layer_id, e)
+        catalog["column_stats"] = None
+
+    catalog["layer_version"] = layer_version(layer["s3_key"], layer["last_edited"])
+
+    async with get_async_db_connection() as conn:
+        await conn.execute(
+            """
+            INSERT INTO layer_catalogs
+            (layer_id, layer_version, driver, crs, feature_count, fields,
+             column_stats, sample_rows, computed_at)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, CURRENT_TIMESTAMP)
+            ON CONFLICT (layer_id) DO UPDATE SET
+                layer_version = EXCLUDED.layer_version,
+                driver = EXCLUDED.driver,
+                crs = EXCLUDED.crs,
+                feature_count = EXCLUDED.feature_count,
+                fields = EXCLUDED.fields,
+                column_stats = EXCLUDED.column_stats,
+                sample_rows = EXCLUDED.sample_rows,
+                computed_at = EXCLUDED.computed_at
+            """,
+            layer_id,
+            catalog["layer_version"],
+            catalog["driver"],
+            catalog["crs"],
+            catalog["feature_count"],
+            json.dumps(catalog["fields"]),
+            json.dumps(catalog["column_stats"]),
+            json.dumps(catalog["sample_rows"]),
+        )
+        await conn.execute(
+            """
+            UPDATE map_layers
+            SET feature_count = $1
+            WHERE layer_id = $2
+            """,
+            catalog["feature_count"],
+            layer_id,
+        )
+
+    return catalog
+
+
+def _refresh_once(layer_id: str) -> asyncio.Task:
+    task = _catalog_refreshes.get(layer_id)
+    if task is None:
+        task = asyncio.ensure_future(refresh_layer_catalog(layer_id))
+        _catalog_refreshes[layer_id] = task
+        task.add_done_callback(lambda _: _catalog_refreshes.pop(layer_id, None))
+    return task
+
+
+def start_catalog_refresh(layer_id: str):
+    """Build the catalog in the background, so ingest doesn't wait on it.
+
+    Until it lands, get_layer_catalog waits on the same build.
+    """
+    _refresh_once(layer_id).add_done_callback(_catalog_refresh_finished)
+
+
+def _catalog_refresh_finished(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Building layer catalog failed: {task.exception()}")
+
+
+async def get_layer_catalog(layer_id: str, s3_key: str, last_edited) -> Dict[str, Any]:
+    """Stored catalog for the layer's current version, computing it if needed."""
+    async with get_async_db_connection() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT layer_version, driver, crs, feature_count, fields,
+                   column_stats, sample_rows
+            FROM layer_catalogs
+            WHERE layer_id = $1
+            """,
+            layer_id,
+        )
+
+    if not row or row["layer_version"] != layer_version(s3_key, last_edited):
+        # layers ingested before the catalog existed, or rewritten since.
+        # shield so one cancelled request doesn't abort the build for the others
+        return await asyncio.shield(_refresh_once(layer_id))
+
+    catalog = dict(row)
+    # asyncpg returns JSON columns as strings
+    for column in ("fields", "column_stats", "sample_rows"):
+        if isinstance(catalog[column], str):
+            catalog[column] = json.loads(catalog[column])
+    return catalog
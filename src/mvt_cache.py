@@ -0,0 +1,263 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+import asyncpg
+from redis import Redis
+
+from src.structures import async_conn
+
+
+class MvtTileCache:
+    """Redis cache of MVT tiles rendered from PostGIS layers.
+
+    Tiles are keyed on the layer, a hash of its postgis_query and z/x/y, so
+    editing a layer's query misses the cache by itself. A layer can have
+    thousands of cached tiles, so instead of indexing them all,
+    invalidate() bumps a per-layer generation that is part of every key and
+    lets the old tiles expire.
+    """
+
+    def __init__(self, redis: Redis, ttl: int):
+        self.redis = redis  # binary client, tiles are raw protobuf
+        self.ttl = ttl
+
+    def _generation_key(self, layer_id: str) -> str:
+        return f"mvt_cache:generation:{layer_id}"
+
+    def _key(self, layer_id: str, query: str, z: int, x: int, y: int) -> str:
+        generation = int(self.redis.get(self._generation_key(layer_id)) or 0)
+        digest = hashlib.sha256(query.encode()).hexdigest()[:16]
+        return f"mvt_cache:{layer_id}:{generation}:{digest}:{z}/{x}/{y}"
+
+    def get(self, layer_id: str, query: str, z: int, x: int, y: int) -> Optional[bytes]:
+        # empty tiles are cached too, as b""
+        return self.redis.get(self._key(layer_id, query, z, x, y))
+
+    def set(self, layer_id: str, query: str, z: int, x: int, y: int, tile: bytes):
+        self.redis.set(self._key(layer_id, query, z, x, y), tile, ex=self.ttl)
+
+    def invalidate(self, layer_id: str):
+        """Make every cached tile of layer_id a miss."""
+        self.redis.incr(self._generation_key(layer_id))
+
+
+@lru_cache(maxsize=1)
+def get_mvt_cache() -> MvtTileCache:
+    return MvtTileCache(
+        Redis(
+            host=os.environ["REDIS_HOST"],
+            port=int(os.environ["REDIS_PORT"]),
+        ),
+        ttl=int(os.environ.get("MVT_CACHE_TTL_SECONDS", "3600")),
+    )
+
+
+@dataclass
+class PostgisLayerInfo:
+    type: str
+    owner_uuid: str
+    connection_id: Optional[str]
+    connection_user_id: Optional[str]
+    connection_uri: Optional[str]
+    postgis_query: Optional[str]
+    # resolved against the customer database when the first tile is drawn
+    srid: Optional[int] = None
+    tile_query: Optional[str] = None
+    resolved: bool = False
+
+
+def _quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def build_tile_query(postgis_query: str, geometry_column: str, srid: int) -> str:
+    """ST_AsMVT query for one layer, taking the tile envelope as $1..$4.
+
+    The SRID and geometry column are inlined, so the text is fixed per layer
+    and asyncpg's statement cache can reuse the prepared statement.
+    """
+    column = _quote_identifier(geometry_column)
+    native = "wm_geom" if srid == 3857 else f"ST_Transform(wm_geom, {int(srid)})"
+    # some geometries just aren't valid, so make them valid.
+    # can't save the world
+    return f"""
+    WITH
+    bounds AS (
+        SELECT {native} AS nat_geom, wm_geom::box2d AS b2d
+        FROM (SELECT ST_MakeEnvelope($1, $2, $3, $4, 3857) AS wm_geom) e
+    ),
+    mvtgeom AS (
+        SELECT ST_AsMVTGeom(ST_Transform(ST_MakeValid(t.{column}), 3857), b.b2d) AS geom
+        FROM ({postgis_query}) t, bounds b
+        WHERE t.{column} && b.nat_geom
+          AND ST_Intersects(t.{column}, b.nat_geom)
+    )
+    SELECT ST_AsMVT(mvtgeom.*, 'reprojectedfgb') FROM mvtgeom
+    """
+
+
+class PostgisLayerInfoCache:
+    """In-process LRU of what the MVT path needs to know about a PostGIS layer.
+
+    Owner, query and connection details come from the app database in one
+    lookup; the geometry column and SRID are resolved against the customer
+    database once, on the first tile. Like MvtTileCache, invalidation bumps
+    a generation in Redis, per layer and per connection, which every hit
+    checks, so all workers drop the entry at once. Entries also expire after
+    ttl seconds.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, redis: Optional[Redis] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._redis = redis
+        self.entries: OrderedDict[str, tuple[float, tuple, PostgisLayerInfo]] = (
+            OrderedDict()
+        )
+
+    @property
+    def redis(self) -> Redis:
+        # shares the tile cache's client unless given one
+        return self._redis or get_mvt_cache().redis
+
+    def _layer_generation_key(self, layer_id: str) -> str:
+        return f"postgis_layer_info:generation:{layer_id}"
+
+    def _connection_generation_key(self, connection_id: str) -> str:
+        return f"postgis_layer_info:generation:connection:{connection_id}"
+
+    def _generations(self, layer_id: str, connection_id: Optional[str]) -> tuple:
+        keys = [self._layer_generation_key(layer_id)]
+        if connection_id:
+            keys.append(self._connection_generation_key(connection_id))
+        return tuple(self.redis.mget(keys))
+
+    def _cached(self, layer_id: str) -> Optional[PostgisLayerInfo]:
+        entry = self.entries.get(layer_id)
+        if entry is None:
+            return None
+        expires_at, generations, info = entry
+        if expires_at > time.monotonic() and generations == self._generations(
+            layer_id, info.connection_id
+        ):
+            self.entries.move_to_end(layer_id)
+            return info
+        self.entries.pop(layer_id, None)
+        return None
+
+    def _put(self, layer_id: str, info: PostgisLayerInfo):
+        self.entries[layer_id] = (
+            time.monotonic() + self.ttl,
+            self._generations(layer_id, info.connection_id),
+            info,
+        )
+        self.entries.move_to_end(layer_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def get(self, layer_id: str) -> Optional[PostgisLayerInfo]:
+        info = self._cached(layer_id)
+        if info is not None:
+            return info
+
+        async with async_conn("mvt") as conn:
+            row = await conn.fetchrow(
+                """
+                SELECT l.type, l.owner_uuid, l.postgis_connection_id, l.postgis_query,
+                       c.user_id AS connection_user_id, c.connection_uri
+                FROM map_layers l
+                LEFT JOIN project_postgres_connections c
+                    ON c.id = l.postgis_connection_id
+                WHERE l.layer_id = $1
+                """,
+                layer_id,
+            )
+        if not row:
+            return None
+
+        info = PostgisLayerInfo(
+            type=row["type"],
+            owner_uuid=str(row["owner_uuid"]),
+            connection_id=row["postgis_connection_id"],
+            connection_user_id=(
+                str(row["connection_user_id"]) if row["connection_user_id"] else None
+            ),
+            connection_uri=row["connection_uri"],
+            postgis_query=row["postgis_query"],
+        )
+        self._put(layer_id, info)
+        return info
+
+    async def resolve(self, info: PostgisLayerInfo, conn: asyncpg.Connection):
+        """Find the geometry column and SRID of the layer's query, once."""
+        if info.resolved:
+            return
+
+        # column types come back with the prepared statement, no rows needed
+        statement = await conn.prepare(
+            f"SELECT * FROM ({info.postgis_query}) t LIMIT 0"
+        )
+        geometry_columns = [
+            attribute.name
+            for attribute in statement.get_attributes()
+            if attribute.type.name == "geometry"
+        ]
+        if not geometry_columns:
+            raise ValueError("PostGIS query has no geometry column")
+        geometry_column = "geom" if "geom" in geometry_columns else geometry_columns[0]
+
+        column = _quote_identifier(geometry_column)
+        info.srid = await conn.fetchval(
+            f"""
+            SELECT ST_SRID(t.{column}) FROM ({info.postgis_query}) t
+            WHERE t.{column} IS NOT NULL
+            LIMIT 1
+            """
+        )
+        if info.srid is not None:
+            info.tile_query = build_tile_query(
+                info.postgis_query, geometry_column, info.srid
+            )
+        # an empty layer has no SRID yet; resolved again once the entry expires
+        info.resolved = True
+
+    def invalidate(self, layer_id: str):
+        """Drop layer_id's entry in every worker."""
+        self.entries.pop(layer_id, None)
+        self.redis.incr(self._layer_generation_key(layer_id))
+
+    def invalidate_connection(self, connection_id: str):
+        """Drop the entries of every layer on connection_id, in every worker."""
+        for layer_id in [
+            layer_id
+            for layer_id, (_, _, info) in self.entries.items()
+            if info.connection_id == connection_id
+        ]:
+            self.entries.pop(layer_id, None)
+        self.redis.incr(self._connection_generation_key(connection_id))
+
+
+postgis_layer_info = PostgisLayerInfoCache(
+    max_entries=1024,
+    ttl=float(os.environ.get("POSTGIS_LAYER_INFO_TTL_SECONDS", "300")),
+)
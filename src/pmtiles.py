@@ -0,0 +1,248 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import os
+import struct
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+# https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md
+HEADER_LENGTH = 127
+MAX_DIRECTORY_DEPTH = 4
+
+COMPRESSION_UNKNOWN, COMPRESSION_NONE, COMPRESSION_GZIP = 0, 1, 2
+
+TILE_MEDIA_TYPES = {
+    1: "application/vnd.mapbox-vector-tile",
+    2: "image/png",
+    3: "image/jpeg",
+    4: "image/webp",
+    5: "image/avif",
+}
+
+# tile_compression -> Content-Encoding, tiles are served as stored
+TILE_CONTENT_ENCODINGS = {2: "gzip", 3: "br", 4: "zstd"}
+
+
+class PMTilesError(Exception):
+    pass
+
+
+@dataclass
+class Header:
+    root_offset: int
+    root_length: int
+    leaf_directory_offset: int
+    tile_data_offset: int
+    internal_compression: int
+    tile_compression: int
+    tile_type: int
+    min_zoom: int
+    max_zoom: int
+
+
+@dataclass
+class Directory:
+    # parallel lists sorted by tile_id; run_length 0 marks a leaf directory
+    tile_ids: list[int]
+    run_lengths: list[int]
+    offsets: list[int]
+    lengths: list[int]
+
+
+def parse_header(data: bytes) -> Header:
+    if len(data) < HEADER_LENGTH or data[:7] != b"PMTiles":
+        raise PMTilesError("Not a PMTiles archive")
+    if data[7] != 3:
+        raise PMTilesError(f"Unsupported PMTiles version {data[7]}")
+    (
+        root_offset,
+        root_length,
+        _metadata_offset,
+        _metadata_length,
+        leaf_directory_offset,
+        _leaf_directory_length,
+        tile_data_offset,
+    ) = struct.unpack_from("<7Q", data, 8)
+    internal_compression, tile_compression, tile_type, min_zoom, max_zoom = (
+        struct.unpack_from("<5B", data, 97)
+    )
+    return Header(
+        root_offset=root_offset,
+        root_length=root_length,
+        leaf_directory_offset=leaf_directory_offset,
+        tile_data_offset=tile_data_offset,
+        internal_compression=internal_compression,
+        tile_compression=tile_compression,
+        tile_type=tile_type,
+        min_zoom=min_zoom,
+        max_zoom=max_zoom,
+    )
+
+
+def decompress(data: bytes, compression: int) -> bytes:
+    if compression == COMPRESSION_NONE:
+        return data
+    if compression == COMPRESSION_GZIP:
+        try:
+            return gzip.decompress(data)
+        except (OSError, EOFError, zlib.error) as e:
+            raise PMTilesError(f"Corrupt PMTiles directory: {e}") from None
+    raise PMTilesError(f"Unsupported PMTiles internal compression {compression}")
+
+
+def _read_varints(data: bytes, pos: int, count: int) -> tuple[list[int], int]:
+    values = []
+    for _ in range(count):
+        value = shift = 0
+        while True:
+            if pos >= len(data):
+                raise PMTilesError("Truncated PMTiles directory")
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        values.append(value)
+    return values, pos
+
+
+def parse_directory(data: bytes) -> Directory:
+    """Decode an uncompressed directory into parallel entry lists."""
+    (count,), pos = _read_varints(data, 0, 1)
+    deltas, pos = _read_varints(data, pos, count)
+    run_lengths, pos = _read_varints(data, pos, count)
+    lengths, pos = _read_varints(data, pos, count)
+    raw_offsets, pos = _read_varints(data, pos, count)
+
+    tile_ids = []
+    tile_id = 0
+    for delta in deltas:
+        tile_id += delta
+        tile_ids.append(tile_id)
+
+    # 0 means "directly after the previous entry", anything else is offset + 1
+    offsets = []
+    for i, raw in enumerate(raw_offsets):
+        if raw == 0 and i == 0:
+            raise PMTilesError("Corrupt PMTiles directory")
+        if raw == 0:
+            offsets.append(offsets[i - 1] + lengths[i - 1])
+        else:
+            offsets.append(raw - 1)
+    return Directory(tile_ids, run_lengths, offsets, lengths)
+
+
+def zxy_to_tile_id(z: int, x: int, y: int) -> int:
+    """Tile ids count up through zoom levels, along a Hilbert curve within each."""
+    n = 1 << z
+    if not (0 <= x < n and 0 <= y < n):
+        raise ValueError(f"Tile {z}/{x}/{y} out of range")
+    tile_id = ((1 << (2 * z)) - 1) // 3  # tiles in all lower zooms
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        tile_id += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x, y = n - 1 - x, n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return tile_id
+
+
+def find_entry(directory: Directory, tile_id: int) -> Optional[tuple[int, int, int]]:
+    """(offset, length, run_length) of the entry covering tile_id, if any."""
+    i = bisect_right(directory.tile_ids, tile_id) - 1
+    if i < 0:
+        return None
+    run_length = directory.run_lengths[i]
+    if run_length == 0 or tile_id < directory.tile_ids[i] + run_length:
+        return directory.offsets[i], directory.lengths[i], run_length
+    return None
+
+
+class DirectoryCache:
+    """LRU of decoded headers and directories, keyed by archive version and offset."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+async def read_tile(
+    archive_id: str,
+    read: Callable[[int, int], Awaitable[bytes]],
+    cache: DirectoryCache,
+    z: int,
+    x: int,
+    y: int,
+) -> tuple[Header, Optional[tuple[int, int]]]:
+    """Locate a tile in a PMTiles archive.
+
+    `read(offset, length)` fetches bytes of the archive, and archive_id must
+    change whenever its content does. Returns the header and the tile's
+    absolute (offset, length), or None when the archive has no such tile.
+    """
+    header = cache.get((archive_id, "header"))
+    if header is None:
+        header = parse_header(await read(0, HEADER_LENGTH))
+        cache.set((archive_id, "header"), header)
+
+    if z < header.min_zoom or z > header.max_zoom:
+        return header, None
+    tile_id = zxy_to_tile_id(z, x, y)
+
+    offset, length = header.root_offset, header.root_length
+    for _ in range(MAX_DIRECTORY_DEPTH):
+        directory = cache.get((archive_id, offset))
+        if directory is None:
+            directory = parse_directory(
+                decompress(await read(offset, length), header.internal_compression)
+            )
+            cache.set((archive_id, offset), directory)
+
+        entry = find_entry(directory, tile_id)
+        if entry is None:
+            return header, None
+        entry_offset, entry_length, run_length = entry
+        if run_length > 0:
+            return header, (header.tile_data_offset + entry_offset, entry_length)
+        offset = header.leaf_directory_offset + entry_offset
+        length = entry_length
+    raise PMTilesError("PMTiles directories nested too deeply")
+
+
+directory_cache = DirectoryCache(
+    max_entries=int(os.environ.get("PMTILES_DIRECTORY_CACHE_SIZE", "512"))
+)
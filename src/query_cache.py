@@ -0,0 +1,102 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import re
+from functools import lru_cache
+from typing import Optional
+
+from redis import Redis
+
+# quoted strings and identifiers are kept verbatim, only whitespace
+# between tokens is collapsed
+_SQL_TOKENS = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|\s+|[^'"\s]+)""")
+
+
+def normalize_sql(sql: str) -> str:
+    """Canonical form of a query for cache keys, whitespace and trailing ;
+    differences don't produce a different key."""
+    parts = []
+    for token in _SQL_TOKENS.findall(sql.strip()):
+        parts.append(" " if token.isspace() else token)
+    return "".join(parts).rstrip("; ")
+
+
+class QueryResultCache:
+    """Redis cache of tool query results.
+
+    Entries are keyed on the normalized SQL, the row cap and the sources the
+    query ran against: layer IDs with their version for DuckDB, or the
+    connection ID for PostGIS. A rewritten layer gets a new version and so
+    new keys, and every entry is also indexed by source so it can be
+    dropped explicitly with invalidate().
+    """
+
+    def __init__(self, redis: Redis, ttl: int):
+        self.redis = redis
+        self.ttl = ttl
+
+    def _key(
+        self, kind: str, sources: dict[str, str], sql: str, max_rows: Optional[int]
+    ) -> str:
+        digest = hashlib.sha256(
+            json.dumps(
+                [kind, sorted(sources.items()), normalize_sql(sql), max_rows]
+            ).encode()
+        ).hexdigest()
+        return f"query_cache:{kind}:{digest}"
+
+    def get(
+        self, kind: str, sources: dict[str, str], sql: str, max_rows: Optional[int]
+    ) -> Optional[dict]:
+        cached = self.redis.get(self._key(kind, sources, sql, max_rows))
+        return json.loads(cached) if cached else None
+
+    def set(
+        self,
+        kind: str,
+        sources: dict[str, str],
+        sql: str,
+        max_rows: Optional[int],
+        result: dict,
+    ):
+        key = self._key(kind, sources, sql, max_rows)
+        pipe = self.redis.pipeline()
+        pipe.set(key, json.dumps(result), ex=self.ttl)
+        for source_id in sources:
+            index_key = f"query_cache:source:{source_id}"
+            pipe.sadd(index_key, key)
+            pipe.expire(index_key, self.ttl)
+        pipe.execute()
+
+    def invalidate(self, source_id: str):
+        """Drop every cached result that read from source_id."""
+        index_key = f"query_cache:source:{source_id}"
+        keys = self.redis.smembers(index_key)
+        self.redis.delete(index_key, *keys)
+
+
+@lru_cache(maxsize=1)
+def get_query_cache() -> QueryResultCache:
+    return QueryResultCache(
+        Redis(
+            host=os.environ["REDIS_HOST"],
+            port=int(os.environ["REDIS_PORT"]),
+            decode_responses=True,
+        ),
+        ttl=int(os.environ.get("QUERY_CACHE_TTL_SECONDS", "600")),
+    )
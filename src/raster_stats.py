@@ -0,0 +1,164 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import logging
+import math
+import os
+import tempfile
+from typing import Optional
+
+from osgeo import gdal
+
+from src.structures import get_async_db_connection
+from src.utils import get_async_s3_client, get_bucket_name
+
+logger = logging.getLogger(__name__)
+
+# Rasters with more pixels than this get approximate (overview or subsampled)
+# statistics at upload, optionally refined to exact ones in the background
+RASTER_STATS_APPROX_PIXELS = int(
+    os.environ.get("RASTER_STATS_APPROX_PIXELS", 50_000_000)
+)
+RASTER_STATS_REFINE = os.environ.get("RASTER_STATS_REFINE", "1") != "0"
+HISTOGRAM_BUCKETS = 32
+
+_refinements: set[asyncio.Task] = set()
+
+
+def _finite(value) -> Optional[float]:
+    # JSONB has no NaN or Infinity
+    return float(value) if value is not None and math.isfinite(value) else None
+
+
+def compute_raster_stats(path: str, approx: Optional[bool] = None) -> dict:
+    """Statistics and a histogram for every band of a raster.
+
+    With approx=None, approximate statistics are used for rasters larger
+    than RASTER_STATS_APPROX_PIXELS. Blocking, run it in an executor.
+    """
+    ds = gdal.Open(path)
+    if ds is None:
+        raise ValueError(f"Could not open raster: {gdal.GetLastErrorMsg()}")
+    if approx is None:
+        approx = ds.RasterXSize * ds.RasterYSize > RASTER_STATS_APPROX_PIXELS
+
+    bands = []
+    for index in range(1, ds.RasterCount + 1):
+        band = ds.GetRasterBand(index)
+        band_stats = {"band": index, "nodata": _finite(band.GetNoDataValue())}
+        # [min, max, mean, stdev], None when every pixel is nodata
+        stats = band.ComputeStatistics(approx)
+        if stats:
+            min_val, max_val, mean, stddev = stats
+            band_stats.update(
+                min=_finite(min_val),
+                max=_finite(max_val),
+                mean=_finite(mean),
+                stddev=_finite(stddev),
+            )
+            if band_stats["min"] is not None and band_stats["max"] is not None:
+                # a constant band has no range to split, so it gets one
+                # bucket around its value instead of HISTOGRAM_BUCKETS empty ones
+                constant = min_val == max_val
+                band_stats["histogram"] = {
+                    "min": band_stats["min"],
+                    "max": band_stats["max"],
+                    # buckets are half open, include_out_of_range puts the
+                    # pixels equal to max into the last bucket
+                    "counts": band.GetHistogram(
+                        min=min_val - 0.5 if constant else min_val,
+                        max=max_val + 0.5 if constant else max_val,
+                        buckets=1 if constant else HISTOGRAM_BUCKETS,
+                        include_out_of_range=1,
+                        approx_ok=approx,
+                    ),
+                }
+        bands.append(band_stats)
+    ds = None
+
+    return {"approximate": approx, "bands": bands}
+
+
+def stats_metadata(stats: dict) -> dict:
+    """Layer metadata entries for computed statistics.
+
+    Single band rasters also get raster_value_stats_b1, which drives the
+    color ramp in map styles and COG generation.
+    """
+    metadata = {"raster_stats": stats}
+    bands = stats["bands"]
+    if len(bands) == 1 and bands[0].get("min") is not None:
+        metadata["raster_value_stats_b1"] = {
+            "min": bands[0]["min"],
+            "max": bands[0]["max"],
+        }
+    return metadata
+
+
+async def compute_raster_metadata(path: str) -> dict:
+    stats = await asyncio.get_running_loop().run_in_executor(
+        None, compute_raster_stats, path
+    )
+    return stats_metadata(stats)
+
+
+async def refine_raster_stats(layer_id: str):
+    """Replace a layer's approximate statistics with exact ones."""
+    async with get_async_db_connection() as conn:
+        s3_key = await conn.fetchval(
+            "SELECT s3_key FROM map_layers WHERE layer_id = $1", layer_id
+        )
+    if not s3_key:
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_file = os.path.join(
+            temp_dir, f"layer_{layer_id}{os.path.splitext(s3_key)[1]}"
+        )
+        s3 = await get_async_s3_client()
+        await s3.download_file(get_bucket_name(), s3_key, local_file)
+        stats = await asyncio.get_running_loop().run_in_executor(
+            None, compute_raster_stats, local_file, False
+        )
+
+    # merge rather than overwrite, metadata may have changed meanwhile
+    async with get_async_db_connection() as conn:
+        await conn.execute(
+            """
+            UPDATE map_layers
+            SET metadata = COALESCE(metadata, '{}'::jsonb) || $1::jsonb
+            WHERE layer_id = $2
+            """,
+            json.dumps(stats_metadata(stats)),
+            layer_id,
+        )
+    logger.info(f"Refined raster statistics for layer {layer_id}")
+
+
+def start_stats_refinement(layer_id: str):
+    """Refine approximate statistics in the background, if enabled."""
+    if not RASTER_STATS_REFINE:
+        return
+    task = asyncio.ensure_future(refine_raster_stats(layer_id))
+    _refinements.add(task)
+    task.add_done_callback(_refinement_finished)
+
+
+def _refinement_finished(task: asyncio.Task):
+    _refinements.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Raster statistics refinement failed: {task.exception()}")
@@ -0,0 +1,132 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+from typing import Optional
+
+import numpy as np
+from osgeo import gdal
+from PIL import Image
+
+from src.fs_lru import MemoryCache
+
+TILE_SIZE = 256
+WEB_MERCATOR_HALF_WIDTH = 20037508.342789244
+
+# Same ramp the frontend's cog protocol applies for "#color:BrewerSpectral9"
+BREWER_SPECTRAL9 = np.array(
+    [
+        [0xD5, 0x3E, 0x4F],
+        [0xF4, 0x6D, 0x43],
+        [0xFD, 0xAE, 0x61],
+        [0xFE, 0xE0, 0x8B],
+        [0xFF, 0xFF, 0xBF],
+        [0xE6, 0xF5, 0x98],
+        [0xAB, 0xDD, 0xA4],
+        [0x66, 0xC2, 0xA5],
+        [0x32, 0x88, 0xBD],
+    ],
+    dtype=np.float64,
+)
+
+PIL_FORMATS = {"png": "PNG", "webp": "WEBP"}
+
+# Encoded tiles, keyed by layer version, tile and color ramp
+tile_cache = MemoryCache(
+    max_size=int(os.environ.get("RASTER_TILE_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    max_entry_size=1024 * 1024,
+)
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """(minx, miny, maxx, maxy) of an XYZ tile in EPSG:3857."""
+    size = 2 * WEB_MERCATOR_HALF_WIDTH / (1 << z)
+    minx = -WEB_MERCATOR_HALF_WIDTH + x * size
+    maxy = WEB_MERCATOR_HALF_WIDTH - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def apply_color_ramp(values: np.ndarray, vmin: float, vmax: float) -> np.ndarray:
+    """Map values onto the Spectral ramp, continuous between vmin and vmax.
+
+    Returns a (3, H, W) uint8 array.
+    """
+    if vmax > vmin:
+        t = np.clip((values - vmin) / (vmax - vmin), 0, 1)
+    else:
+        t = np.zeros(values.shape)
+    t = t * (len(BREWER_SPECTRAL9) - 1)
+    positions = np.arange(len(BREWER_SPECTRAL9))
+    return np.stack(
+        [np.interp(t, positions, BREWER_SPECTRAL9[:, c]) for c in range(3)]
+    ).astype(np.uint8)
+
+
+def render_raster_tile(
+    path: str,
+    z: int,
+    x: int,
+    y: int,
+    image_format: str,
+    value_range: Optional[tuple[float, float]] = None,
+) -> bytes:
+    """Render one XYZ tile of a (Cloud Optimized) GeoTIFF as PNG or WebP.
+
+    GDAL picks the closest overview for the requested resolution, so low
+    zooms read only a small part of the file. Single band rasters are
+    colored with the Spectral ramp over value_range, or stretched to grey
+    without one. Returns b"" when the tile has no data at all.
+
+    Blocking, run it in an executor.
+    """
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    warped = gdal.Warp(
+        "",
+        path,
+        format="MEM",
+        outputBounds=(minx, miny, maxx, maxy),
+        width=TILE_SIZE,
+        height=TILE_SIZE,
+        dstSRS="EPSG:3857",
+        resampleAlg="bilinear",
+        dstAlpha=True,
+    )
+    if warped is None:
+        raise RuntimeError(f"Failed to warp {path} to tile {z}/{x}/{y}")
+    data = warped.ReadAsArray()
+    warped = None
+
+    alpha = data[-1].astype(np.uint8)
+    if not alpha.any():
+        return b""
+    bands = data[:-1]
+
+    if len(bands) >= 3:
+        rgb = np.clip(bands[:3], 0, 255).astype(np.uint8)
+    else:
+        values = bands[0].astype(np.float64)
+        if value_range is not None:
+            rgb = apply_color_ramp(values, *value_range)
+        else:
+            valid = values[alpha > 0]
+            lo, hi = float(valid.min()), float(valid.max())
+            grey = np.clip((values - lo) / ((hi - lo) or 1) * 255, 0, 255)
+            rgb = np.stack([grey.astype(np.uint8)] * 3)
+
+    rgba = np.dstack([rgb[0], rgb[1], rgb[2], alpha])
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, "RGBA").save(buffer, format=PIL_FORMATS[image_format])
+    return buffer.getvalue()
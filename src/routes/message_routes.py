@@ -56,7 +56,9 @@ from src.geoprocessing.dispatch import (
     get_tools,
 )
 from src.dependencies.base_map import get_base_map_provider
-from src.duckdb import execute_duckdb_query
+from src.duckdb import execute_duckdb_query, referenced_layer_ids
+from src.fs_lru import layer_version
+from src.query_cache import get_query_cache
 from src.utils import get_async_s3_client, get_bucket_name
 from src.dependencies.postgis import get_postgis_provider
 from src.dependencies.layer_describer import LayerDescriber, get_layer_describer
@@ -590,7 +592,7 @@ async def process_chat_interaction_task(
                         "type": "function",
                         "function": {
                             "name": "query_duckdb_sql",
-                            "description": "Execute a SQL query against vector layer data using DuckDB",
+                            "description": "Execute a SQL query against vector layer data using DuckDB with the spatial extension. Each layer is a table named by its layer ID, so one query can join several layers, e.g. spatial joins with ST_Intersects",
                             "strict": True,
                             "parameters": {
                                 "type": "object",
@@ -598,7 +600,7 @@ async def process_chat_interaction_task(
                                 "properties": {
                                     "layer_ids": {
                                         "type": "array",
-                                        "description": "Load these vector layer IDs as tables",
+                                        "description": "Load these vector layer IDs as tables, include every layer the query references",
                                         "items": {"type": "string"},
                                     },
                                     "sql_query": {
@@ -1114,25 +1116,27 @@ async def process_chat_interaction_task(
                                     )
                                 )
                         elif function_name == "query_duckdb_sql":
-                            layer_id = tool_args.get("layer_ids", [None])[
-                                0
-                            ]  # Use first layer or None
+                            layer_ids = tool_args.get("layer_ids") or []
                             sql_query = tool_args.get("sql_query")
                             head_n_rows = tool_args.get("head_n_rows", 20)
 
-                            layer_exists = await conn.fetchrow(
+                            owned_layers = await conn.fetch(
                                 """
-                                SELECT layer_id FROM map_layers
-                                WHERE layer_id = $1 AND owner_uuid = $2
+                                SELECT layer_id, s3_key, last_edited FROM map_layers
+                                WHERE layer_id = ANY($1) AND owner_uuid = $2
                                 """,
-                                layer_id,
+                                layer_ids,
                                 user_id,
                             )
+                            owned_ids = {row["layer_id"] for row in owned_layers}
+                            missing_ids = [
+                                lid for lid in layer_ids if lid not in owned_ids
+                            ]
 
-                            if not layer_exists:
+                            if not layer_ids or missing_ids:
                                 tool_result = {
                                     "status": "error",
-                                    "error": f"Layer ID '{layer_id}' not found or you do not have permission to access it.",
+                                    "error": f"Layer ID(s) {', '.join(repr(lid) for lid in missing_ids) or 'none given'} not found or you do not have permission to access them.",
                                 }
                                 await add_chat_completion_message(
                                     ChatCompletionToolMessageParam(
@@ -1143,46 +1147,74 @@ async def process_chat_interaction_task(
                                 )
                                 continue
 
-                            try:
-                                # Execute the query using the async function
-                                async with kue_ephemeral_action(
-                                    map_id, "Querying with SQL...", layer_id=layer_id
-                                ):
-                                    result = await execute_duckdb_query(
-                                        sql_query=sql_query,
-                                        layer_id=layer_id,
-                                        max_n_rows=head_n_rows,
-                                        timeout=10,
-                                    )
-
-                                # Convert result to CSV format
-                                df = pd.DataFrame(
-                                    result["result"], columns=result["headers"]
+                            # results are keyed on the versions of the layers the
+                            # SQL reads, so a rewritten layer never serves stale rows
+                            mounted_ids = referenced_layer_ids(
+                                sql_query or "", layer_ids
+                            )
+                            layer_versions = {
+                                row["layer_id"]: layer_version(
+                                    row["s3_key"], row["last_edited"]
                                 )
-                                result_text = df.to_csv(index=False)
+                                for row in owned_layers
+                                if row["layer_id"] in mounted_ids
+                            }
+                            query_cache = get_query_cache()
+                            tool_result = query_cache.get(
+                                "duckdb", layer_versions, sql_query, head_n_rows
+                            )
+                            if tool_result is None:
+                                try:
+                                    # Execute the query using the async function
+                                    async with kue_ephemeral_action(
+                                        map_id,
+                                        "Querying with SQL...",
+                                        layer_id=layer_ids[0],
+                                    ):
+                                        result = await execute_duckdb_query(
+                                            sql_query=sql_query,
+                                            layer_ids=layer_ids,
+                                            max_n_rows=head_n_rows,
+                                            timeout=10,
+                                        )
 
-                                if len(result_text) > 25000:
+                                    # Convert result to CSV format
+                                    df = pd.DataFrame(
+                                        result["result"], columns=result["headers"]
+                                    )
+                                    result_text = df.to_csv(index=False)
+
+                                    if len(result_text) > 25000:
+                                        tool_result = {
+                                            "status": "error",
+                                            "error": f"DuckDB CSV result too large: {len(result_text)} characters exceeds 25,000 character limit, try reducing columns or head_n_rows",
+                                        }
+                                    else:
+                                        tool_result = {
+                                            "status": "success",
+                                            "result": result_text,
+                                            "row_count": result["row_count"],
+                                            "query": sql_query,
+                                        }
+                                except HTTPException as e:
                                     tool_result = {
                                         "status": "error",
-                                        "error": f"DuckDB CSV result too large: {len(result_text)} characters exceeds 25,000 character limit, try reducing columns or head_n_rows",
+                                        "error": f"DuckDB query error: {e.detail}",
                                     }
-                                else:
+                                except Exception as e:
                                     tool_result = {
-                                        "status": "success",
-                                        "result": result_text,
-                                        "row_count": result["row_count"],
-                                        "query": sql_query,
+                                        "status": "error",
+                                        "error": f"Error executing SQL query: {str(e)}",
                                     }
-                            except HTTPException as e:
-                                tool_result = {
-                                    "status": "error",
-                                    "error": f"DuckDB query error: {e.detail}",
-                                }
-                            except Exception as e:
-                                tool_result = {
-                                    "status": "error",
-                                    "error": f"Error executing SQL query: {str(e)}",
-                                }
+
+                                if tool_result["status"] == "success":
+                                    query_cache.set(
+                                        "duckdb",
+                                        layer_versions,
+                                        sql_query,
+                                        head_n_rows,
+                                        tool_result,
+                                    )
 
                             await add_chat_completion_message(
                                 ChatCompletionToolMessageParam(
@@ -1453,6 +1485,25 @@ async def process_chat_interaction_task(
                                             )
                                             continue
 
+                                        # external databases change under us, so
+                                        # these entries only live for the cache TTL
+                                        query_cache = get_query_cache()
+                                        cached_result = query_cache.get(
+                                            "postgis",
+                                            {postgis_connection_id: ""},
+                                            limited_query,
+                                            None,
+                                        )
+                                        if cached_result is not None:
+                                            await add_chat_completion_message(
+                                                ChatCompletionToolMessageParam(
+                                                    role="tool",
+                                                    tool_call_id=tool_call.id,
+                                                    content=json.dumps(cached_result),
+                                                ),
+                                            )
+                                            continue
+
                                         async with kue_ephemeral_action(
                                             map_id, "Querying PostgreSQL database..."
                                         ):
@@ -1532,6 +1583,15 @@ async def process_chat_interaction_task(
                                             finally:
                                                 await postgres_conn.close()
 
+                                        if tool_result["status"] == "success":
+                                            query_cache.set(
+                                                "postgis",
+                                                {postgis_connection_id: ""},
+                                                limited_query,
+                                                None,
+                                                tool_result,
+                                            )
+
                                     except Exception as e:
                                         tool_result = {
                                             "status": "error",
@@ -58,6 +58,9 @@ from osgeo import gdal
 import subprocess
 from src.symbology.llm import generate_maplibre_layers_for_layer_id
 from src.routes.layer_router import describe_layer_internal
+from src.cog import start_cog_job
+from src.layer_catalog import start_catalog_refresh
+from src.raster_stats import compute_raster_metadata, start_stats_refinement
 from ..structures import get_async_db_connection, async_conn
 from ..dependencies.base_map import BaseMapProvider, get_base_map_provider
 from ..dependencies.postgis import get_postgis_provider
@@ -1349,24 +1352,17 @@ async def internal_upload_layer(
 
                         bounds = [xmin, ymin, xmax, ymax]
 
-                    # Get statistics for single-band rasters
-                    if ds.RasterCount == 1:
-                        try:
-                            band = ds.GetRasterBand(1)
-                            # ComputeStatistics(approx_ok, force)
-                            stats = band.ComputeStatistics(
-                                False
-                            )  # [min, max, mean, stdev]
-                            min_val, max_val = stats[0], stats[1]
-                            metadata_dict["raster_value_stats_b1"] = {
-                                "min": min_val,
-                                "max": max_val,
-                            }
-                        except Exception as e:
-                            print(f"Error computing raster statistics: {str(e)}")
-
                     # Close dataset
                     ds = None
+
+                    # Statistics and histograms for every band, read in a
+                    # worker thread (approximate for very large rasters)
+                    try:
+                        metadata_dict.update(
+                            await compute_raster_metadata(temp_file_path)
+                        )
+                    except Exception as e:
+                        print(f"Error computing raster statistics: {str(e)}")
             else:
                 # Get bounds from vector file and detect geometry type
                 with fiona.open(temp_file_path) as collection:
@@ -1465,6 +1461,18 @@ async def internal_upload_layer(
 
             new_layer_id = new_layer_result["layer_id"]
 
+            # Build the schema/statistics catalog in the background, the
+            # upload response doesn't need it
+            if layer_type == "vector":
+                start_catalog_refresh(new_layer_id)
+
+            # Convert rasters to COG in the background so the first view
+            # doesn't have to wait for the whole GDAL pipeline
+            if layer_type == "raster":
+                start_cog_job(new_layer_id)
+                if metadata_dict.get("raster_stats", {}).get("approximate"):
+                    start_stats_refinement(new_layer_id)
+
             # If adding layer to map, update the map with the new layer
             if add_layer_to_map:
                 # First get the current layers array
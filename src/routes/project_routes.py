@@ -43,6 +43,8 @@ from src.utils import (
 import io
 from opentelemetry import trace
 from ..structures import get_async_db_connection
+from ..query_cache import get_query_cache
+from ..mvt_cache import postgis_layer_info
 from ..dependencies.base_map import get_base_map_provider
 from ..dependencies.database_documenter import (
     DatabaseDocumenter,
@@ -674,6 +676,8 @@ async def soft_delete_postgis_connection(
             connection_id,
             project_id,
         )
+        get_query_cache().invalidate(connection_id)
+        postgis_layer_info.invalidate_connection(connection_id)
 
         return PostgresConnectionResponse(
             success=True, message="PostgreSQL connection deleted successfully"
@@ -13,11 +13,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import json
 import pytest
 import random
 from pathlib import Path
 import re
 
+from src import layer_catalog
+from src.structures import get_async_db_connection
+
 
 @pytest.fixture
 async def test_map_with_coho_layer(auth_client):
@@ -138,3 +143,60 @@ async def test_describe_layer_not_found(auth_client):
 
     # Should get a 404 Not Found response
     assert response.status_code == 404, f"Expected 404, got {response.status_code}"
+
+
+@pytest.mark.anyio
+async def test_catalog_is_built_at_ingest(test_map_with_coho_layer, auth_client):
+    layer_id = test_map_with_coho_layer["layer_id"]
+
+    async with get_async_db_connection() as conn:
+        catalog = await conn.fetchrow(
+            """
+            SELECT driver, crs, feature_count, fields, column_stats, sample_rows
+            FROM layer_catalogs
+            WHERE layer_id = $1
+            """,
+            layer_id,
+        )
+
+    assert catalog is not None, "Catalog should be written when the layer is uploaded"
+    assert catalog["driver"] == "GPKG"
+    assert catalog["crs"] == "EPSG:3857"
+    assert catalog["feature_count"] == 677
+
+    fields = {f["name"]: f["type"] for f in json.loads(catalog["fields"])}
+    assert fields["OBJECTID"] == "int32"
+    assert fields["Acreage"] == "float"
+    assert len(json.loads(catalog["sample_rows"])) == 10
+
+    stats = {s["name"]: s for s in json.loads(catalog["column_stats"])}
+    assert stats["OBJECTID"]["null_count"] == 0
+    assert "geom" not in stats
+
+    # describe is served from the catalog, including the statistics
+    response = await auth_client.get(f"/api/layer/{layer_id}/describe")
+    assert response.status_code == 200
+    assert "## Column Statistics" in response.text
+    assert "column,type,min,max,distinct_count,null_count" in response.text
+
+
+@pytest.mark.anyio
+async def test_concurrent_catalog_misses_share_one_refresh(auth_client, monkeypatch):
+    refreshes = []
+
+    async def fake_refresh(layer_id, local_path=None):
+        refreshes.append(layer_id)
+        await asyncio.sleep(0.1)
+        return {"layer_id": layer_id}
+
+    monkeypatch.setattr(layer_catalog, "refresh_layer_catalog", fake_refresh)
+
+    # no stored catalog for this layer, so every call misses
+    catalogs = await asyncio.gather(
+        *[
+            layer_catalog.get_layer_catalog("L123456789012", "uploads/x.gpkg", None)
+            for _ in range(5)
+        ]
+    )
+    assert catalogs == [{"layer_id": "L123456789012"}] * 5
+    assert refreshes == ["L123456789012"]
@@ -0,0 +1,266 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import json
+import os
+from pathlib import Path
+from types import SimpleNamespace
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import shapely
+
+from src.dependencies.session import EditOrReadOnlyUserContext
+from src.routes import layer_router
+from src.routes.layer_router import (
+    _first_valid_sql_candidate,
+    _sign_query,
+    _store_query_token,
+)
+
+
+class StubCompletions:
+    def __init__(self, contents: list[str]):
+        self.contents = contents
+        self.calls = []
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        return SimpleNamespace(
+            choices=[
+                SimpleNamespace(message=SimpleNamespace(content=content))
+                for content in self.contents
+            ]
+        )
+
+
+@pytest.mark.anyio
+async def test_first_valid_sql_candidate_skips_invalid_sql():
+    completions = StubCompletions(
+        [
+            "SELECT missing_column FROM (SELECT 1 AS one)",
+            "SELECT one FROM (SELECT 1 AS one)",
+            "SELECT one FROM (SELECT 1 AS one)",
+        ]
+    )
+    client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    sql_query, first_error = await _first_valid_sql_candidate(
+        client, {"model": "stub"}, [], "LTEST0000001"
+    )
+
+    assert sql_query == "SELECT one FROM (SELECT 1 AS one)"
+    assert first_error is None
+    # every candidate comes from a single completion request
+    assert len(completions.calls) == 1
+
+
+@pytest.mark.anyio
+async def test_first_valid_sql_candidate_reports_first_error():
+    completions = StubCompletions(["SELECT missing_column FROM (SELECT 1 AS one)"])
+    client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    sql_query, first_error = await _first_valid_sql_candidate(
+        client, {"model": "stub"}, [], "LTEST0000001"
+    )
+
+    assert sql_query is None
+    failed_sql, error = first_error
+    assert failed_sql == "SELECT missing_column FROM (SELECT 1 AS one)"
+    assert "missing_column" in error
+
+
+@pytest.fixture
+async def counties_layer(auth_client):
+    map_payload = {
+        "project": {"layers": [], "crs": {"epsg_code": 3857}},
+        "title": "Layer Query Test Map",
+        "description": "Test map for layer queries",
+    }
+
+    map_response = await auth_client.post("/api/maps/create", json=map_payload)
+    assert map_response.status_code == 200, f"Failed to create map: {map_response.text}"
+    map_id = map_response.json()["id"]
+
+    file_path = str(
+        Path(__file__).parent.parent.parent / "test_fixtures" / "UScounties.gpkg"
+    )
+
+    if not os.path.exists(file_path):
+        pytest.skip(f"Test file {file_path} not found")
+
+    with open(file_path, "rb") as f:
+        files = {"file": ("UScounties.gpkg", f)}
+        data = {"layer_name": "UScounties"}
+
+        layer_response = await auth_client.post(
+            f"/api/maps/{map_id}/layers", files=files, data=data
+        )
+
+        assert layer_response.status_code == 200, (
+            f"Failed to upload layer: {layer_response.text}"
+        )
+        return layer_response.json()["id"]
+
+
+def stub_generated_sql(monkeypatch, sql_query: str):
+    client = SimpleNamespace(
+        chat=SimpleNamespace(completions=StubCompletions([sql_query]))
+    )
+    monkeypatch.setattr(layer_router, "get_openai_client", lambda: client)
+
+
+@pytest.mark.anyio
+async def test_query_layer_pages_past_max_n_rows(
+    counties_layer, auth_client, monkeypatch
+):
+    stub_generated_sql(monkeypatch, f"SELECT * FROM {counties_layer} LIMIT 60")
+
+    response = await auth_client.post(
+        f"/api/layer/{counties_layer}/query",
+        json={"natural_language_query": "any 60 counties", "max_n_rows": 25},
+    )
+    assert response.status_code == 200, response.text
+    page = response.json()
+    pages = [page]
+    while page["next_cursor"]:
+        response = await auth_client.post(
+            f"/api/layer/{counties_layer}/query",
+            json={
+                "natural_language_query": "any 60 counties",
+                "max_n_rows": 25,
+                "cursor": page["next_cursor"],
+            },
+        )
+        assert response.status_code == 200, response.text
+        page = response.json()
+        pages.append(page)
+
+    assert [page["row_count"] for page in pages] == [25, 25, 10]
+    assert [page["offset"] for page in pages] == [0, 25, 50]
+    assert pages[-1]["has_more"] is False
+    assert pages[-1]["next_cursor"] is None
+
+
+@pytest.mark.anyio
+async def test_query_layer_rejects_expired_and_foreign_cursors(
+    counties_layer, auth_client
+):
+    user_id = EditOrReadOnlyUserContext().get_user_id()
+    expired_token = _store_query_token(counties_layer, user_id, "SELECT 1")
+    layer_router.redis.delete(f"duckdb_cursor:{expired_token}")
+
+    foreign_tokens = [
+        expired_token,
+        # issued for another user
+        _store_query_token(counties_layer, "someone-else", "SELECT 1"),
+        # issued for another layer
+        _store_query_token("LOTHERLAYER1", user_id, "SELECT 1"),
+    ]
+
+    for token in foreign_tokens:
+        response = await auth_client.post(
+            f"/api/layer/{counties_layer}/query",
+            json={"natural_language_query": "next page", "cursor": token},
+        )
+        assert response.status_code == 400, response.text
+
+
+@pytest.mark.anyio
+async def test_export_rejects_unsigned_queries(counties_layer, auth_client):
+    user_id = EditOrReadOnlyUserContext().get_user_id()
+    query = f"SELECT * FROM {counties_layer}"
+
+    forged = [
+        # signed query with other SQL swapped in
+        ("SELECT 42", _sign_query(counties_layer, user_id, query)),
+        # signed for another user
+        (query, _sign_query(counties_layer, "someone-else", query)),
+        # signed for another layer
+        (query, _sign_query("LOTHERLAYER1", user_id, query)),
+    ]
+
+    for forged_query, signature in forged:
+        response = await auth_client.get(
+            f"/api/layer/{counties_layer}/export",
+            params={"query": forged_query, "signature": signature},
+        )
+        assert response.status_code == 400, response.text
+
+
+async def export_query(auth_client, monkeypatch, layer_id: str, format: str):
+    stub_generated_sql(monkeypatch, f"SELECT * FROM {layer_id} LIMIT 100")
+    response = await auth_client.post(
+        f"/api/layer/{layer_id}/query",
+        json={"natural_language_query": "any 100 counties"},
+    )
+    assert response.status_code == 200, response.text
+
+    result = response.json()
+    response = await auth_client.get(
+        f"/api/layer/{layer_id}/export",
+        params={
+            "query": result["query"],
+            "signature": result["query_signature"],
+            "format": format,
+        },
+    )
+    assert response.status_code == 200, response.text
+    return response
+
+
+def assert_wkb_geometries(table: pa.Table):
+    assert pa.types.is_binary(table.schema.field("geom").type)
+    geometries = shapely.from_wkb(table.column("geom").to_pylist())
+    assert all(geometry.geom_type.endswith("Polygon") for geometry in geometries)
+
+
+@pytest.mark.anyio
+async def test_export_arrow(counties_layer, auth_client, monkeypatch):
+    response = await export_query(auth_client, monkeypatch, counties_layer, "arrow")
+    assert response.headers["content-type"] == "application/vnd.apache.arrow.stream"
+
+    table = pa.ipc.open_stream(response.content).read_all()
+    assert table.num_rows == 100
+    assert_wkb_geometries(table)
+
+
+@pytest.mark.anyio
+async def test_export_parquet(counties_layer, auth_client, monkeypatch):
+    response = await export_query(auth_client, monkeypatch, counties_layer, "parquet")
+    assert response.headers["content-type"] == "application/vnd.apache.parquet"
+
+    table = pq.read_table(io.BytesIO(response.content))
+    assert table.num_rows == 100
+    assert b"geo" not in (table.schema.metadata or {})
+    assert_wkb_geometries(table)
+
+
+@pytest.mark.anyio
+async def test_export_geoparquet(counties_layer, auth_client, monkeypatch):
+    response = await export_query(
+        auth_client, monkeypatch, counties_layer, "geoparquet"
+    )
+    assert response.headers["content-type"] == "application/vnd.apache.parquet"
+
+    table = pq.read_table(io.BytesIO(response.content))
+    assert table.num_rows == 100
+    geo = json.loads(table.schema.metadata[b"geo"])
+    assert geo["primary_column"] == "geom"
+    assert geo["columns"]["geom"]["encoding"] == "WKB"
+    assert "crs" in geo["columns"]["geom"]
+    assert_wkb_geometries(table)
@@ -0,0 +1,447 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import hashlib
+import os
+import re
+import secrets
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+from src.fs_lru import block_cache
+from src.utils import get_async_s3_client
+
+# Chunks start small so the first bytes of a tile range go out quickly, then
+# double up to the max for throughput on large reads
+S3_STREAM_MIN_CHUNK = 64 * 1024
+S3_STREAM_MAX_CHUNK = 1024 * 1024
+
+# Object size/ETag lookups are reused for this long instead of a HEAD per request
+S3_HEAD_CACHE_TTL = float(os.environ.get("S3_HEAD_CACHE_TTL", "60"))
+S3_HEAD_CACHE_SIZE = 1024
+
+# Ranges up to this size go through the block cache and coalescing reader;
+# larger ones (whole-file downloads) stream straight from S3
+COALESCE_MAX_RANGE = 256 * 1024
+COALESCE_WINDOW = float(os.environ.get("S3_RANGE_COALESCE_WINDOW", "0.005"))
+COALESCE_MAX_GAP = 64 * 1024
+COALESCE_MAX_SPAN = 4 * 1024 * 1024
+
+# More ranges than this in one request get the whole object instead
+MAX_RANGES = 32
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class S3ObjectChanged(Exception):
+    """The object no longer has the ETag a read was made against."""
+
+
+def _precondition_failed(e: Exception) -> bool:
+    response = getattr(e, "response", None) or {}
+    return (
+        response.get("Error", {}).get("Code") in ("PreconditionFailed", "412")
+        or response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 412
+    )
+
+
+def parse_range_header(header: str, size: int) -> Optional[list[tuple[int, int]]]:
+    """Parse a Range header into inclusive (start, end) byte ranges.
+
+    Overlapping and adjacent ranges are merged. Returns None when the header
+    should be ignored and the whole object served (other units, malformed
+    specs, more than MAX_RANGES ranges, or ranges that add up to more than
+    the object itself), and raises RangeNotSatisfiable when no range
+    overlaps the object.
+    """
+    match = re.fullmatch(r"\s*bytes\s*=\s*(.+)", header)
+    if not match:
+        return None
+
+    specs = match.group(1).split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        spec = spec.strip()
+        if not spec:
+            continue
+        spec_match = re.fullmatch(r"(\d*)\s*-\s*(\d*)", spec)
+        if not spec_match or spec_match.groups() == ("", ""):
+            return None
+        first, last = spec_match.groups()
+        if first == "":
+            # suffix range, the last N bytes
+            suffix = int(last)
+            if suffix == 0:
+                continue
+            ranges.append((max(size - suffix, 0), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(int(last), size - 1) if last else size - 1))
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+    # e.g. bytes=0-,0-,0- would otherwise stream the object once per range
+    if sum(end - start + 1 for start, end in ranges) > size:
+        return None
+    return coalesce_ranges(ranges, max_gap=0, max_span=size + 1)
+
+
+def coalesce_ranges(
+    ranges: list[tuple[int, int]],
+    max_gap: int = COALESCE_MAX_GAP,
+    max_span: int = COALESCE_MAX_SPAN,
+) -> list[tuple[int, int]]:
+    """Merge ranges that overlap or sit within max_gap bytes of each other."""
+    spans: list[tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if spans:
+            span_start, span_end = spans[-1]
+            if (
+                start <= span_end + max_gap + 1
+                and max(end, span_end) - span_start < max_span
+            ):
+                spans[-1] = (span_start, max(end, span_end))
+                continue
+        spans.append((start, end))
+    return spans
+
+
+async def stream_s3_object(
+    bucket_name: str,
+    key: str,
+    start_byte: Optional[int] = None,
+    end_byte: Optional[int] = None,
+    etag: Optional[str] = None,
+):
+    """Stream an S3 object, or an inclusive byte range of it, with the async client.
+
+    With etag, the GET is conditional and S3ObjectChanged is raised if the
+    object has been overwritten since.
+    """
+    s3 = await get_async_s3_client()
+    kwargs = {"Bucket": bucket_name, "Key": key}
+    if start_byte is not None:
+        kwargs["Range"] = f"bytes={start_byte}-{end_byte}"
+    if etag:
+        kwargs["IfMatch"] = etag
+    try:
+        s3_response = await s3.get_object(**kwargs)
+    except Exception as e:
+        if etag and _precondition_failed(e):
+            s3_head_cache.invalidate(bucket_name, key)
+            raise S3ObjectChanged(f"{bucket_name}/{key} changed") from e
+        raise
+
+    body = s3_response["Body"]
+    chunk_size = S3_STREAM_MIN_CHUNK
+    try:
+        while True:
+            chunk = await body.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+            chunk_size = min(chunk_size * 2, S3_STREAM_MAX_CHUNK)
+    finally:
+        body.close()
+
+
+class S3HeadCache:
+    """Short-lived cache of (size, ETag) per S3 object."""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple[str, str], tuple[float, int, str]] = (
+            OrderedDict()
+        )
+
+    async def get(self, bucket_name: str, key: str) -> tuple[int, str]:
+        entry = self._entries.get((bucket_name, key))
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end((bucket_name, key))
+            return entry[1], entry[2]
+
+        s3 = await get_async_s3_client()
+        head = await s3.head_object(Bucket=bucket_name, Key=key)
+        size, etag = head["ContentLength"], head.get("ETag", "")
+        self._entries[(bucket_name, key)] = (time.monotonic() + self.ttl, size, etag)
+        self._entries.move_to_end((bucket_name, key))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return size, etag
+
+    def invalidate(self, bucket_name: str, key: str):
+        self._entries.pop((bucket_name, key), None)
+
+
+class CoalescingRangeReader:
+    """Batches small range reads of the same object into fewer S3 GETs.
+
+    Reads arriving within `window` seconds of the first one are grouped, and
+    ranges close enough to each other are fetched with a single GET and
+    sliced back out. Map clients fire many tiny reads per viewport, mostly
+    into neighbouring parts of the file. Reads made against an ETag are
+    only grouped with reads of the same ETag, and sent with If-Match.
+    """
+
+    def __init__(self, window: float, max_gap: int, max_span: int):
+        self.window = window
+        self.max_gap = max_gap
+        self.max_span = max_span
+        self._pending: dict[
+            tuple[str, str, Optional[str]], list[tuple[int, int, asyncio.Future]]
+        ] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def read(
+        self,
+        bucket_name: str,
+        key: str,
+        start: int,
+        end: int,
+        etag: Optional[str] = None,
+    ) -> bytes:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.get((bucket_name, key, etag))
+        if pending is None:
+            pending = self._pending[(bucket_name, key, etag)] = []
+            task = asyncio.ensure_future(self._flush_later(bucket_name, key, etag))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        pending.append((start, end, future))
+        return await future
+
+    async def _flush_later(self, bucket_name: str, key: str, etag: Optional[str]):
+        await asyncio.sleep(self.window)
+        reads = self._pending.pop((bucket_name, key, etag))
+        spans = coalesce_ranges(
+            [(start, end) for start, end, _ in reads], self.max_gap, self.max_span
+        )
+        await asyncio.gather(
+            *(
+                self._fetch_span(
+                    bucket_name,
+                    key,
+                    etag,
+                    span_start,
+                    span_end,
+                    [r for r in reads if span_start <= r[0] and r[1] <= span_end],
+                )
+                for span_start, span_end in spans
+            )
+        )
+
+    async def _fetch_span(
+        self,
+        bucket_name: str,
+        key: str,
+        etag: Optional[str],
+        span_start: int,
+        span_end: int,
+        reads: list[tuple[int, int, asyncio.Future]],
+    ):
+        try:
+            s3 = await get_async_s3_client()
+            kwargs = {"Range": f"bytes={span_start}-{span_end}"}
+            if etag:
+                # never splice bytes of a newer version into cached blocks
+                kwargs["IfMatch"] = etag
+            response = await s3.get_object(Bucket=bucket_name, Key=key, **kwargs)
+            body = response["Body"]
+            try:
+                data = await body.read()
+            finally:
+                body.close()
+        except Exception as e:
+            for _, _, future in reads:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for start, end, future in reads:
+            if not future.done():
+                future.set_result(data[start - span_start : end - span_start + 1])
+
+
+s3_head_cache = S3HeadCache(S3_HEAD_CACHE_TTL, S3_HEAD_CACHE_SIZE)
+range_reader = CoalescingRangeReader(
+    COALESCE_WINDOW, COALESCE_MAX_GAP, COALESCE_MAX_SPAN
+)
+
+
+async def read_cached_range(
+    bucket_name: str, key: str, etag: str, size: int, start: int, end: int
+) -> bytes:
+    """Small range of an S3 object, through the local block cache.
+
+    Raises S3ObjectChanged, after dropping what is cached about the object,
+    if it no longer has the given ETag.
+    """
+    object_id = hashlib.sha1(f"{bucket_name}/{key}:{etag}:{size}".encode()).hexdigest()[
+        :20
+    ]
+    try:
+        return await block_cache().read(
+            object_id,
+            size,
+            start,
+            end,
+            lambda block_start, block_end: range_reader.read(
+                bucket_name, key, block_start, block_end, etag
+            ),
+        )
+    except Exception as e:
+        if etag and _precondition_failed(e):
+            s3_head_cache.invalidate(bucket_name, key)
+            block_cache().invalidate(object_id)
+            raise S3ObjectChanged(f"{bucket_name}/{key} changed") from e
+        raise
+
+
+async def _read_range(
+    bucket_name: str, key: str, etag: str, size: int, start: int, end: int
+):
+    if end - start + 1 <= COALESCE_MAX_RANGE:
+        yield await read_cached_range(bucket_name, key, etag, size, start, end)
+    else:
+        async for chunk in stream_s3_object(bucket_name, key, start, end, etag):
+            yield chunk
+
+
+async def _multipart_body(
+    bucket_name: str,
+    key: str,
+    etag: str,
+    size: int,
+    parts: list[tuple[bytes, int, int]],
+    boundary: str,
+):
+    # queue every small read up front so they land in the same coalescing window
+    prefetched = [
+        asyncio.ensure_future(
+            read_cached_range(bucket_name, key, etag, size, start, end)
+        )
+        if end - start + 1 <= COALESCE_MAX_RANGE
+        else None
+        for _, start, end in parts
+    ]
+    try:
+        for (part_header, start, end), prefetch in zip(parts, prefetched):
+            yield part_header
+            if prefetch is not None:
+                yield await prefetch
+            else:
+                async for chunk in stream_s3_object(bucket_name, key, start, end, etag):
+                    yield chunk
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
+    finally:
+        for prefetch in prefetched:
+            if prefetch is not None:
+                prefetch.cancel()
+
+
+async def serve_s3_object(
+    request: Request,
+    bucket_name: str,
+    key: str,
+    media_type: str,
+    headers: Optional[dict] = None,
+) -> Response:
+    """Serve an S3 object with single and multi-range support.
+
+    Sizes and ETags come from a short-lived cache, conditional requests
+    are answered with 304, and small ranges are served from the local block
+    cache, with misses sharing S3 GETs through the coalescing reader.
+    """
+    size, etag = await s3_head_cache.get(bucket_name, key)
+    headers = {**(headers or {}), "Accept-Ranges": "bytes"}
+    if etag:
+        headers["ETag"] = etag
+        if request.headers.get("if-none-match") in (etag, "*"):
+            return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    try:
+        ranges = parse_range_header(range_header, size) if range_header else None
+    except RangeNotSatisfiable:
+        return Response(
+            status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"}
+        )
+
+    if ranges is None:
+        headers.update({"Content-Length": str(size), "Content-Type": media_type})
+        return StreamingResponse(
+            stream_s3_object(bucket_name, key, etag=etag),
+            status_code=200,
+            headers=headers,
+        )
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers.update(
+            {
+                "Content-Range": f"bytes {start}-{end}/{size}",
+                "Content-Length": str(end - start + 1),
+                "Content-Type": media_type,
+            }
+        )
+        return StreamingResponse(
+            _read_range(bucket_name, key, etag, size, start, end),
+            status_code=206,
+            headers=headers,
+        )
+
+    boundary = secrets.token_hex(16)
+    parts = [
+        (
+            (
+                f"--{boundary}\r\n"
+                f"Content-Type: {media_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+            ).encode(),
+            start,
+            end,
+        )
+        for start, end in ranges
+    ]
+    content_length = sum(
+        len(part_header) + (end - start + 1) + 2 for part_header, start, end in parts
+    ) + len(f"--{boundary}--\r\n")
+    headers.update(
+        {
+            "Content-Length": str(content_length),
+            "Content-Type": f"multipart/byteranges; boundary={boundary}",
+        }
+    )
+    return StreamingResponse(
+        _multipart_body(bucket_name, key, etag, size, parts, boundary),
+        status_code=206,
+        headers=headers,
+    )
@@ -0,0 +1,104 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import uuid
+
+import numpy as np
+import pytest
+from osgeo import gdal, osr
+
+from src import cog
+
+
+@pytest.mark.anyio
+async def test_concurrent_requests_share_one_cog_job(monkeypatch):
+    layer_id = f"LTEST{uuid.uuid4().hex[:7]}"
+    stored = {}
+    generated = []
+
+    async def fake_fetch_layer(layer_id):
+        return {"s3_key": f"uploads/{layer_id}.tif", "metadata": None, **stored}
+
+    async def fake_generate(self, layer_id, s3_key, metadata):
+        generated.append(layer_id)
+        await asyncio.sleep(0.1)
+        return f"cog/layer/{layer_id}.cog.tif"
+
+    monkeypatch.setattr(cog, "_fetch_layer", fake_fetch_layer)
+    monkeypatch.setattr(cog.CogJobQueue, "_generate", fake_generate)
+
+    queue = cog.CogJobQueue(max_workers=1)
+    first, second = queue.ensure(layer_id), queue.ensure(layer_id)
+    assert first is second
+    assert await asyncio.gather(first, second) == [f"cog/layer/{layer_id}.cog.tif"] * 2
+    assert generated == [layer_id]
+    # the lock is released once the job is done
+    assert cog.redis.get(f"cog_job:{layer_id}") is None
+
+
+@pytest.mark.anyio
+async def test_cog_job_lock_is_renewed_and_only_released_by_its_owner(monkeypatch):
+    layer_id = f"LTEST{uuid.uuid4().hex[:7]}"
+    lock_key = f"cog_job:{layer_id}"
+
+    async def fake_fetch_layer(layer_id):
+        return {"s3_key": f"uploads/{layer_id}.tif", "metadata": None}
+
+    async def fake_generate(self, layer_id, s3_key, metadata):
+        # outlives the lock's TTL, so only renewal keeps it held
+        await asyncio.sleep(2.5)
+        assert cog.redis.get(lock_key) is not None
+        # the lock lapsed and another worker took it over
+        cog.redis.set(lock_key, "other-worker")
+        return f"cog/layer/{layer_id}.cog.tif"
+
+    monkeypatch.setattr(cog, "_fetch_layer", fake_fetch_layer)
+    monkeypatch.setattr(cog.CogJobQueue, "_generate", fake_generate)
+    monkeypatch.setattr(cog, "COG_JOB_LOCK_SECONDS", 1)
+    monkeypatch.setattr(cog, "COG_JOB_LOCK_RENEW_SECONDS", 0.3)
+
+    try:
+        await cog.CogJobQueue(max_workers=1).ensure(layer_id)
+        assert cog.redis.get(lock_key) == "other-worker"
+    finally:
+        cog.redis.delete(lock_key)
+
+
+def test_paletted_raster_becomes_rgb_cog_with_overviews(tmp_path):
+    path = str(tmp_path / "paletted.tif")
+    ds = gdal.GetDriverByName("GTiff").Create(path, 1024, 1024, 1, gdal.GDT_Byte)
+    ds.SetGeoTransform((-10, 0.01, 0, 10, 0, -0.01))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    band = ds.GetRasterBand(1)
+    band.WriteArray((np.indices((1024, 1024)).sum(axis=0) // 256 % 4).astype(np.uint8))
+    palette = gdal.ColorTable()
+    for index, color in enumerate(
+        [(255, 0, 0, 255), (0, 255, 0, 255), (0, 0, 255, 255), (255, 255, 0, 255)]
+    ):
+        palette.SetColorEntry(index, color)
+    band.SetRasterColorTable(palette)
+    ds = None
+
+    cog_path = cog.build_cog("LTESTPALETTE", path, {}, str(tmp_path))
+
+    ds = gdal.Open(cog_path)
+    assert ds.GetMetadata("IMAGE_STRUCTURE").get("LAYOUT") == "COG"
+    assert ds.RasterCount == 3
+    assert ds.GetRasterBand(1).GetColorTable() is None
+    assert ds.GetRasterBand(1).GetOverviewCount() > 0
+    assert "3857" in ds.GetSpatialRef().GetAuthorityCode(None)
@@ -0,0 +1,204 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import shutil
+import time
+from pathlib import Path
+
+import duckdb
+import pytest
+from fastapi import HTTPException
+
+from src import duckdb as duckdb_module
+from src.duckdb import (
+    DUCKDB_MAX_WORKERS,
+    duckdb_pool,
+    execute_duckdb_query,
+    referenced_layer_ids,
+    stream_duckdb_export,
+)
+from src.fs_lru import FileCache, LayerCache
+
+
+def test_only_referenced_layers_are_mounted():
+    sql = """
+        SELECT a.name, COUNT(*)
+        FROM LPARCELS0001 a
+        JOIN "LFLOODZONE01" b ON ST_Intersects(a.geom, b.geom)
+        GROUP BY a.name
+    """
+    layer_ids = ["LPARCELS0001", "LFLOODZONE01", "LUNUSED00001", "LPARCELS0001"]
+
+    assert referenced_layer_ids(sql, layer_ids) == ["LPARCELS0001", "LFLOODZONE01"]
+
+
+def test_layer_id_prefixes_do_not_match():
+    assert referenced_layer_ids("SELECT * FROM LPARCELS00012", ["LPARCELS0001"]) == []
+
+
+@pytest.mark.anyio
+async def test_pooled_connections_do_not_leak_state():
+    await execute_duckdb_query("CREATE TABLE stash AS SELECT 42 AS answer", [])
+    # the next checkout must not see the previous caller's table
+    with pytest.raises(duckdb.CatalogException):
+        await execute_duckdb_query("SELECT * FROM stash", [])
+
+    with pytest.raises(duckdb.InvalidInputException):
+        await execute_duckdb_query("SET memory_limit = '100GB'", [])
+
+
+@pytest.mark.anyio
+async def test_timed_out_query_is_interrupted():
+    while not duckdb_pool._idle.empty():
+        duckdb_pool._idle.get_nowait().close()
+
+    start = time.monotonic()
+    with pytest.raises(HTTPException) as exc_info:
+        await execute_duckdb_query(
+            "SELECT sum(range) FROM range(1000000000000)", [], timeout=1
+        )
+    assert exc_info.value.status_code == 504
+    assert time.monotonic() - start < 3
+
+    # the interrupted connection was closed, not handed back to the pool
+    assert duckdb_pool._idle.empty()
+
+
+@pytest.mark.anyio
+async def test_cancelled_query_is_interrupted():
+    while not duckdb_pool._idle.empty():
+        duckdb_pool._idle.get_nowait().close()
+
+    task = asyncio.create_task(
+        execute_duckdb_query(
+            "SELECT sum(range) FROM range(1000000000000)", [], timeout=60
+        )
+    )
+    await asyncio.sleep(0.5)
+    start = time.monotonic()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    # cancelling waits for the DuckDB thread to stop rather than orphaning it
+    assert time.monotonic() - start < 2
+    assert duckdb_pool._idle.empty()
+
+
+@pytest.mark.anyio
+async def test_query_reads_geoparquet_built_from_geopackage(tmp_path, monkeypatch):
+    gpkg_path = Path(__file__).parent.parent / "test_fixtures" / "UScounties.gpkg"
+    cache = LayerCache()
+    cache.file_cache = FileCache(
+        cache_dir=str(tmp_path / "cache"), max_size=256 * 1024 * 1024
+    )
+
+    async def fake_lookup(layer_id, extension):
+        return f"{layer_id}-v1.{extension}", f"uploads/{layer_id}.gpkg"
+
+    async def fake_fetch(layer_id, cache_key, s3_key):
+        copy_path = os.path.join(cache.file_cache.tmp_dir, cache_key)
+        shutil.copyfile(gpkg_path, copy_path)
+        cache.file_cache.set_from_path(cache_key, copy_path)
+
+    cache._lookup = fake_lookup
+    cache._fetch_layer = fake_fetch
+    monkeypatch.setattr(duckdb_module, "layer_cache", lambda: cache)
+
+    result = await execute_duckdb_query(
+        "SELECT COUNT(*), COUNT(geom) FROM LCOUNTIES001", ["LCOUNTIES001"]
+    )
+
+    # GeoPackage -> GeoParquet -> DuckDB, each step kept in the cache
+    assert cache.file_cache.keys_with_prefix("LCOUNTIES001-v1.parquet")
+    assert cache.file_cache.keys_with_prefix("LCOUNTIES001-v1.duckdb")
+
+    con = duckdb.connect(":memory:")
+    con.install_extension("spatial")
+    con.load_extension("spatial")
+    expected = con.execute(f"SELECT COUNT(*) FROM ST_Read('{gpkg_path}')").fetchone()[0]
+    con.close()
+    assert expected > 0
+    assert result["result"] == [[expected, expected]]
+
+
+@pytest.mark.anyio
+async def test_closing_export_stream_stops_the_producer():
+    while not duckdb_pool._idle.empty():
+        duckdb_pool._idle.get_nowait().close()
+
+    chunks = stream_duckdb_export(
+        "SELECT range AS n FROM range(1000000000)", [], "arrow", batch_rows=1024
+    )
+    assert await chunks.__anext__()
+
+    # what StreamingResponse does when the client goes away
+    start = time.monotonic()
+    await chunks.aclose()
+    assert time.monotonic() - start < 3
+
+    # the producer's connection was interrupted and closed, and the
+    # executor is free for the next query
+    assert duckdb_pool._idle.empty()
+    result = await execute_duckdb_query("SELECT 1 AS one", [], timeout=5)
+    assert result["result"] == [[1]]
+
+
+@pytest.mark.anyio
+async def test_queued_query_times_out_while_workers_are_busy():
+    busy = [
+        asyncio.create_task(
+            execute_duckdb_query(
+                "SELECT sum(range) FROM range(1000000000000)", [], timeout=60
+            )
+        )
+        for _ in range(DUCKDB_MAX_WORKERS)
+    ]
+    await asyncio.sleep(0.5)
+    try:
+        start = time.monotonic()
+        with pytest.raises(HTTPException) as exc_info:
+            await execute_duckdb_query("SELECT 1", [], timeout=1)
+        assert exc_info.value.status_code == 504
+        # never started, so it is dropped from the queue instead of waiting
+        assert time.monotonic() - start < 2
+    finally:
+        for task in busy:
+            task.cancel()
+        await asyncio.gather(*busy, return_exceptions=True)
+
+
+@pytest.mark.anyio
+async def test_stalled_exports_do_not_block_queries():
+    # as many stalled downloads as there are query workers; each started
+    # export's producer is parked on its full chunk queue
+    exports = [
+        stream_duckdb_export(
+            "SELECT range AS n FROM range(1000000000)", [], "arrow", batch_rows=1024
+        )
+        for _ in range(DUCKDB_MAX_WORKERS)
+    ]
+    first_chunks = [asyncio.ensure_future(export.__anext__()) for export in exports]
+    await asyncio.sleep(0.5)
+    try:
+        result = await execute_duckdb_query("SELECT 1 AS one", [], timeout=2)
+        assert result["result"] == [[1]]
+    finally:
+        for first_chunk in first_chunks:
+            first_chunk.cancel()
+        await asyncio.gather(*first_chunks, return_exceptions=True)
+        for export in exports:
+            await export.aclose()
@@ -0,0 +1,290 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import pytest
+
+from src.fs_lru import (
+    BlockCache,
+    FileCache,
+    LayerCache,
+    SegmentedMemoryCache,
+    _SharedIndex,
+)
+
+
+@pytest.fixture
+def tmp_layer_cache(tmp_path):
+    cache = LayerCache()
+    cache.file_cache = FileCache(cache_dir=str(tmp_path), max_size=1024 * 1024)
+    cache.versions = {}
+
+    async def fake_lookup(layer_id, extension):
+        version = cache.versions.get(layer_id, "v1")
+        return f"{layer_id}-{version}.{extension}", f"uploads/{layer_id}.fgb"
+
+    cache._lookup = fake_lookup
+    return cache
+
+
+@pytest.mark.anyio
+async def test_concurrent_misses_share_one_fetch(tmp_layer_cache):
+    fetches = []
+
+    async def fake_fetch(layer_id, cache_key, s3_key):
+        fetches.append(layer_id)
+        await asyncio.sleep(0.05)
+        tmp_layer_cache.file_cache.set(cache_key, b"gpkg bytes")
+
+    tmp_layer_cache._fetch_layer = fake_fetch
+
+    results = await asyncio.gather(
+        *[tmp_layer_cache.bytes_for_layer("LTESTLAYER01") for _ in range(8)]
+    )
+
+    assert fetches == ["LTESTLAYER01"]
+    assert all(result == b"gpkg bytes" for result in results)
+    assert tmp_layer_cache._inflight == {}
+
+
+@pytest.mark.anyio
+async def test_failed_fetch_is_not_cached(tmp_layer_cache):
+    attempts = []
+
+    async def failing_fetch(layer_id, cache_key, s3_key):
+        attempts.append(layer_id)
+        raise KeyError(f"Layer {layer_id} not found")
+
+    tmp_layer_cache._fetch_layer = failing_fetch
+
+    for _ in range(2):
+        with pytest.raises(KeyError):
+            await tmp_layer_cache.bytes_for_layer("LMISSING0001")
+
+    # a failure must not poison the in-flight registry for later callers
+    assert attempts == ["LMISSING0001", "LMISSING0001"]
+
+
+def test_set_from_path_adopts_file_without_copy(tmp_path):
+    file_cache = FileCache(cache_dir=str(tmp_path / "cache"), max_size=1024 * 1024)
+    src_path = os.path.join(file_cache.tmp_dir, "finished.gpkg")
+    with open(src_path, "wb") as f:
+        f.write(b"x" * 4096)
+    inode = os.stat(src_path).st_ino
+
+    file_cache.set_from_path("LTESTLAYER01.gpkg", src_path)
+
+    cached_path = file_cache.get_path("LTESTLAYER01.gpkg")
+    assert not os.path.exists(src_path)
+    assert os.stat(cached_path).st_ino == inode
+    view = file_cache.get("LTESTLAYER01.gpkg")
+    assert isinstance(view, memoryview)
+    assert view.nbytes == 4096 and view[:4] == b"xxxx"
+
+
+def test_shared_index_one_budget_across_processes(tmp_path):
+    cache_dir = str(tmp_path / "shared")
+    # two FileCache instances stand in for two uvicorn workers on one node
+    worker_a = FileCache(cache_dir=cache_dir, max_size=10_000, shared=True)
+    worker_b = FileCache(cache_dir=cache_dir, max_size=10_000, shared=True)
+
+    worker_a.set("LAAAAAAAAAAA.gpkg", b"a" * 4_000)
+    assert worker_b.has("LAAAAAAAAAAA.gpkg")
+
+    # worker A is reading the file, so worker B must not evict it
+    worker_a.lock("LAAAAAAAAAAA.gpkg")
+    worker_b.set("LBBBBBBBBBBB.gpkg", b"b" * 4_000)
+    worker_b.set("LCCCCCCCCCCC.gpkg", b"c" * 4_000)
+
+    assert worker_a.has("LAAAAAAAAAAA.gpkg")
+    assert os.path.exists(os.path.join(cache_dir, "LAAAAAAAAAAA.gpkg"))
+    assert not worker_a.has("LBBBBBBBBBBB.gpkg")
+    assert not os.path.exists(os.path.join(cache_dir, "LBBBBBBBBBBB.gpkg"))
+    assert worker_a.index.total_size() == 8_000
+
+    worker_a.unlock("LAAAAAAAAAAA.gpkg")
+    worker_b.set("LDDDDDDDDDDD.gpkg", b"d" * 4_000)
+    assert not worker_b.has("LAAAAAAAAAAA.gpkg")
+
+
+def test_expired_entries_are_misses(tmp_path):
+    file_cache = FileCache(cache_dir=str(tmp_path), max_size=1024 * 1024, max_age=60)
+    file_cache.set("LTESTLAYER01.gpkg", b"old")
+    path = os.path.join(str(tmp_path), "LTESTLAYER01.gpkg")
+    os.utime(path, (0, 0))
+
+    file_cache.lock("LTESTLAYER01.gpkg")
+    assert file_cache.has("LTESTLAYER01.gpkg"), "locked entries must not expire"
+    file_cache.unlock("LTESTLAYER01.gpkg")
+
+    assert not file_cache.has("LTESTLAYER01.gpkg")
+    assert not os.path.exists(path)
+
+
+@pytest.mark.anyio
+async def test_expired_layer_is_refetched_through_layer_filename(tmp_layer_cache):
+    tmp_layer_cache.file_cache.max_age = 60
+    fetches = []
+
+    async def fake_fetch(layer_id, cache_key, s3_key):
+        fetches.append(cache_key)
+        tmp_layer_cache.file_cache.set(cache_key, f"fetch {len(fetches)}".encode())
+
+    tmp_layer_cache._fetch_layer = fake_fetch
+
+    async with tmp_layer_cache.layer_filename("LTESTLAYER01") as path:
+        with open(path, "rb") as f:
+            assert f.read() == b"fetch 1"
+    os.utime(path, (0, 0))
+
+    async with tmp_layer_cache.layer_filename("LTESTLAYER01") as path:
+        with open(path, "rb") as f:
+            assert f.read() == b"fetch 2"
+    assert fetches == ["LTESTLAYER01-v1.gpkg"] * 2
+
+
+def test_overlapping_locks_are_reference_counted(tmp_path):
+    file_cache = FileCache(cache_dir=str(tmp_path), max_size=10_000)
+    file_cache.set("LAAAAAAAAAAA.gpkg", b"a" * 4_000)
+
+    # two overlapping layer_filename contexts on the same layer
+    file_cache.lock("LAAAAAAAAAAA.gpkg")
+    file_cache.lock("LAAAAAAAAAAA.gpkg")
+    file_cache.unlock("LAAAAAAAAAAA.gpkg")
+
+    file_cache.set("LBBBBBBBBBBB.gpkg", b"b" * 4_000)
+    file_cache.set("LCCCCCCCCCCC.gpkg", b"c" * 4_000)
+    assert file_cache.has("LAAAAAAAAAAA.gpkg"), "still held by the second context"
+    assert not file_cache.has("LBBBBBBBBBBB.gpkg")
+
+    file_cache.unlock("LAAAAAAAAAAA.gpkg")
+    file_cache.set("LDDDDDDDDDDD.gpkg", b"d" * 4_000)
+    assert not file_cache.has("LCCCCCCCCCCC.gpkg")
+    assert file_cache.has("LAAAAAAAAAAA.gpkg"), "released last, so evicted last"
+    assert file_cache.index.total_size() == 8_000
+
+
+@pytest.mark.anyio
+async def test_rewritten_layer_gets_new_cache_entry(tmp_layer_cache):
+    async def fake_fetch(layer_id, cache_key, s3_key):
+        tmp_layer_cache.file_cache.set(cache_key, cache_key.encode())
+
+    tmp_layer_cache._fetch_layer = fake_fetch
+
+    assert (
+        await tmp_layer_cache.bytes_for_layer("LTESTLAYER01") == b"LTESTLAYER01-v1.gpkg"
+    )
+    tmp_layer_cache.versions["LTESTLAYER01"] = "v2"
+    assert (
+        await tmp_layer_cache.bytes_for_layer("LTESTLAYER01") == b"LTESTLAYER01-v2.gpkg"
+    )
+    # the stale version is left for normal eviction
+    assert sorted(tmp_layer_cache.file_cache.keys_with_prefix("LTESTLAYER01-")) == [
+        "LTESTLAYER01-v1.gpkg",
+        "LTESTLAYER01-v2.gpkg",
+    ]
+
+
+@pytest.mark.anyio
+async def test_derived_formats_build_once_from_the_cache(tmp_layer_cache):
+    builds = []
+
+    async def fake_fetch(layer_id, cache_key, s3_key):
+        builds.append(cache_key)
+        tmp_layer_cache.file_cache.set(cache_key, b"gpkg bytes")
+
+    async def fake_build(layer_id, cache_key):
+        builds.append(cache_key)
+        async with tmp_layer_cache.layer_filename(layer_id, "GeoPackage") as path:
+            with open(path, "rb") as f:
+                tmp_layer_cache.file_cache.set(cache_key, b"from " + f.read())
+
+    tmp_layer_cache._fetch_layer = fake_fetch
+    tmp_layer_cache._build_duckdb = fake_build
+
+    for _ in range(2):
+        async with tmp_layer_cache.layer_filename("LTESTLAYER01", "DuckDB") as path:
+            assert path.endswith("LTESTLAYER01-v1.duckdb")
+            with open(path, "rb") as f:
+                assert f.read() == b"from gpkg bytes"
+
+    assert builds == ["LTESTLAYER01-v1.duckdb", "LTESTLAYER01-v1.gpkg"]
+
+
+def test_hot_blocks_survive_a_scan():
+    cache = SegmentedMemoryCache(max_size=100, protected_fraction=0.5)
+    cache.set("hot", b"h" * 10)
+    assert cache.get("hot") == b"h" * 10  # second touch protects it
+
+    for i in range(20):
+        cache.set(f"scan{i}", b"s" * 10)
+
+    assert cache.get("hot") == b"h" * 10
+    assert cache.get("scan0") is None
+    assert cache.probation_total + cache.protected_total <= 100
+
+
+@pytest.mark.anyio
+async def test_block_cache_serves_repeat_ranges_locally(tmp_path, monkeypatch):
+    monkeypatch.setenv("RANGE_CACHE_BLOCK_BYTES", "16")
+    monkeypatch.setenv("RANGE_CACHE_DIR", str(tmp_path))
+    cache = BlockCache()
+    data = bytes(range(100))
+    fetches = []
+
+    async def fetch(start, end):
+        fetches.append((start, end))
+        return data[start : end + 1]
+
+    assert await cache.read("obj", len(data), 5, 40, fetch) == data[5:41]
+    assert fetches == [(0, 47)]
+
+    # overlapping read only fetches the blocks it doesn't have yet
+    assert await cache.read("obj", len(data), 30, 99, fetch) == data[30:100]
+    assert fetches == [(0, 47), (48, 99)]
+
+    # a fresh RAM tier still finds the blocks on disk
+    cache.memory_cache = SegmentedMemoryCache(max_size=1024)
+    assert await cache.read("obj", len(data), 0, 99, fetch) == data
+    assert len(fetches) == 2
+
+
+def test_layer_cache_env_accepts_booleans(tmp_path, monkeypatch):
+    monkeypatch.setenv("LAYER_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("LAYER_CACHE_SHARED_INDEX", "true")
+    assert isinstance(LayerCache().file_cache.index, _SharedIndex)
+
+    monkeypatch.setenv("LAYER_CACHE_SHARED_INDEX", "false")
+    monkeypatch.setenv("LAYER_CACHE_MAX_BYTES", "128MB")
+    with pytest.raises(ValueError, match="LAYER_CACHE_MAX_BYTES"):
+        LayerCache()
+
+
+def test_reopening_shared_index_reconciles_with_disk(tmp_path):
+    cache_dir = str(tmp_path / "shared")
+    worker_a = FileCache(cache_dir=cache_dir, max_size=10_000, shared=True)
+    worker_a.set("LAAAAAAAAAAA.gpkg", b"a" * 1_000)
+    worker_a.set("LBBBBBBBBBBB.gpkg", b"b" * 2_000)
+
+    # files removed and added behind the index's back
+    os.remove(os.path.join(cache_dir, "LAAAAAAAAAAA.gpkg"))
+    with open(os.path.join(cache_dir, "LCCCCCCCCCCC.gpkg"), "wb") as f:
+        f.write(b"c" * 3_000)
+
+    worker_b = FileCache(cache_dir=cache_dir, max_size=10_000, shared=True)
+    assert not worker_b.has("LAAAAAAAAAAA.gpkg")
+    assert worker_b.has("LCCCCCCCCCCC.gpkg")
+    assert worker_b.index.total_size() == 5_000
@@ -160,6 +160,27 @@ async def test_pmtiles_endpoint(test_map_with_layers, auth_client):
     print(f"PMTiles data received, content length: {len(response.content)} bytes")
 
 
+@pytest.mark.s3
+@pytest.mark.anyio
+async def test_pmtiles_tile_endpoint(test_map_with_layers, auth_client):
+    """Single tiles are read out of the PMTiles archive server-side."""
+    vector_layer_id = test_map_with_layers["vector_layer_id"]
+
+    response = await auth_client.get(f"/api/layer/{vector_layer_id}/0/0/0.pbf")
+    assert response.status_code == 200, response.text
+    assert response.headers["Content-Type"] == "application/vnd.mapbox-vector-tile"
+    assert len(response.content) > 0
+    etag = response.headers["ETag"]
+
+    response = await auth_client.get(
+        f"/api/layer/{vector_layer_id}/0/0/0.pbf", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+    response = await auth_client.get(f"/api/layer/{vector_layer_id}/1/2/0.pbf")
+    assert response.status_code == 400
+
+
 @pytest.mark.s3
 @pytest.mark.anyio
 async def test_cog_endpoint(test_map_with_layers, auth_client):
@@ -206,6 +227,25 @@ async def test_cog_endpoint(test_map_with_layers, auth_client):
     print(f"COG data received, content length: {len(response.content)} bytes")
 
 
+@pytest.mark.s3
+@pytest.mark.anyio
+async def test_raster_tile_endpoint(test_map_with_layers, auth_client):
+    """Raster layers are rendered to PNG/WebP tiles server-side."""
+    raster_layer_id = test_map_with_layers["raster_layer_id"]
+
+    response = await auth_client.get(f"/api/layer/{raster_layer_id}/0/0/0.png")
+    assert response.status_code == 200, response.text
+    assert response.headers["Content-Type"] == "image/png"
+    assert response.content.startswith(b"\x89PNG")
+
+    response = await auth_client.get(f"/api/layer/{raster_layer_id}/0/0/0.webp")
+    assert response.status_code == 200, response.text
+    assert response.content[8:12] == b"WEBP"
+
+    response = await auth_client.get(f"/api/layer/{raster_layer_id}/0/0/0.gif")
+    assert response.status_code == 422
+
+
 @pytest.mark.s3
 @pytest.mark.anyio
 async def test_format_mismatch_error(test_map_with_layers, auth_client):
@@ -0,0 +1,82 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import uuid
+
+from src.mvt_cache import (
+    PostgisLayerInfo,
+    PostgisLayerInfoCache,
+    build_tile_query,
+    get_mvt_cache,
+)
+
+
+def test_tiles_are_keyed_on_query_and_invalidated():
+    cache = get_mvt_cache()
+    layer_id = f"LTEST{uuid.uuid4().hex[:7]}"
+    query = "SELECT geom FROM parcels"
+
+    cache.set(layer_id, query, 3, 1, 2, b"\x1a\x02mvt")
+    cache.set(layer_id, query, 3, 1, 3, b"")
+
+    assert cache.get(layer_id, query, 3, 1, 2) == b"\x1a\x02mvt"
+    # empty tiles are hits too
+    assert cache.get(layer_id, query, 3, 1, 3) == b""
+    assert cache.get(layer_id, query, 3, 2, 2) is None
+    assert cache.get(layer_id, "SELECT geom FROM roads", 3, 1, 2) is None
+
+    cache.invalidate(layer_id)
+    assert cache.get(layer_id, query, 3, 1, 2) is None
+
+
+def test_tile_query_inlines_srid_and_geometry_column():
+    query = build_tile_query("SELECT * FROM parcels", "the_geom", 4326)
+    assert "ST_Transform(wm_geom, 4326) AS nat_geom" in query
+    assert 't."the_geom" && b.nat_geom' in query
+    assert "ST_SRID" not in query
+
+    # already in web mercator, the envelope is used as is
+    query = build_tile_query("SELECT * FROM parcels", "geom", 3857)
+    assert "wm_geom AS nat_geom" in query
+
+
+def test_layer_info_invalidation_reaches_every_worker():
+    # two workers, each with its own in-process cache
+    workers = [PostgisLayerInfoCache(max_entries=8, ttl=300) for _ in range(2)]
+    layer_id = f"LTEST{uuid.uuid4().hex[:7]}"
+    connection_id = f"C{uuid.uuid4().hex[:11]}"
+
+    def fill():
+        for worker in workers:
+            worker._put(
+                layer_id,
+                PostgisLayerInfo(
+                    type="postgis",
+                    owner_uuid="00000000-0000-0000-0000-000000000000",
+                    connection_id=connection_id,
+                    connection_user_id=None,
+                    connection_uri="postgresql://example/db",
+                    postgis_query="SELECT geom FROM parcels",
+                ),
+            )
+        assert all(worker._cached(layer_id) is not None for worker in workers)
+
+    fill()
+    workers[0].invalidate(layer_id)
+    assert [worker._cached(layer_id) for worker in workers] == [None, None]
+
+    fill()
+    workers[1].invalidate_connection(connection_id)
+    assert [worker._cached(layer_id) for worker in workers] == [None, None]
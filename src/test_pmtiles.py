@@ -0,0 +1,140 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import struct
+
+import pytest
+
+from src.pmtiles import (
+    DirectoryCache,
+    PMTilesError,
+    parse_directory,
+    read_tile,
+    zxy_to_tile_id,
+)
+
+
+def _varints(values):
+    out = bytearray()
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+
+def _directory(entries):
+    """entries: (tile_id, offset, length, run_length), sorted by tile_id"""
+    tile_ids = [e[0] for e in entries]
+    deltas = [tile_ids[0]] + [b - a for a, b in zip(tile_ids, tile_ids[1:])]
+    return gzip.compress(
+        _varints([len(entries)])
+        + _varints(deltas)
+        + _varints([e[3] for e in entries])
+        + _varints([e[2] for e in entries])
+        + _varints([e[1] + 1 for e in entries])
+    )
+
+
+def _archive(tiles: dict[int, bytes]):
+    """Archive whose root points at a single leaf directory holding every tile."""
+    data = b""
+    entries = []
+    for tile_id, tile in sorted(tiles.items()):
+        entries.append((tile_id, len(data), len(tile), 1))
+        data += tile
+    leaf = _directory(entries)
+    root = _directory([(0, 0, len(leaf), 0)])
+
+    root_offset = 127
+    leaf_offset = root_offset + len(root)
+    data_offset = leaf_offset + len(leaf)
+    header = bytearray(127)
+    header[:8] = b"PMTiles\x03"
+    struct.pack_into(
+        "<7Q",
+        header,
+        8,
+        root_offset,
+        len(root),
+        data_offset,
+        0,
+        leaf_offset,
+        len(leaf),
+        data_offset,
+    )
+    # gzip directories, uncompressed MVT tiles, zooms 0-2
+    struct.pack_into("<5B", header, 97, 2, 1, 1, 0, 2)
+    return bytes(header) + root + leaf + data
+
+
+def test_tile_ids_follow_the_hilbert_curve():
+    assert zxy_to_tile_id(0, 0, 0) == 0
+    assert [zxy_to_tile_id(1, x, y) for x, y in [(0, 0), (0, 1), (1, 1), (1, 0)]] == [
+        1,
+        2,
+        3,
+        4,
+    ]
+    assert zxy_to_tile_id(2, 0, 0) == 5
+    with pytest.raises(ValueError):
+        zxy_to_tile_id(1, 2, 0)
+
+
+@pytest.mark.anyio
+async def test_read_tile_through_leaf_directory():
+    archive = _archive({0: b"world", 3: b"z1 tile", 7: b"z2 tile"})
+    reads = []
+
+    async def read(offset, length):
+        reads.append(offset)
+        return archive[offset : offset + length]
+
+    cache = DirectoryCache(max_entries=8)
+
+    header, tile = await read_tile("a1", read, cache, 1, 1, 1)
+    assert archive[tile[0] : tile[0] + tile[1]] == b"z1 tile"
+    assert header.max_zoom == 2
+
+    # directories are decoded once, then served from the cache
+    reads.clear()
+    _, tile = await read_tile("a1", read, cache, 0, 0, 0)
+    assert archive[tile[0] : tile[0] + tile[1]] == b"world"
+    assert reads == []
+
+    assert (await read_tile("a1", read, cache, 1, 0, 0))[1] is None
+    assert (await read_tile("a1", read, cache, 3, 0, 0))[1] is None
+
+
+def test_truncated_directory_is_a_pmtiles_error():
+    directory = gzip.decompress(_directory([(0, 0, 10, 1), (1, 10, 10, 1)]))
+    for end in range(len(directory)):
+        with pytest.raises(PMTilesError):
+            parse_directory(directory[:end])
+
+
+@pytest.mark.anyio
+async def test_corrupt_directory_is_a_pmtiles_error():
+    archive = bytearray(_archive({0: b"world"}))
+    # chop the gzip stream of the root directory
+    archive[127 + 10 :] = b"\x00" * (len(archive) - 137)
+
+    async def read(offset, length):
+        return bytes(archive[offset : offset + length])
+
+    with pytest.raises(PMTilesError):
+        await read_tile("corrupt", read, DirectoryCache(max_entries=8), 0, 0, 0)
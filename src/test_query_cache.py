@@ -0,0 +1,50 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import uuid
+
+from src.query_cache import get_query_cache, normalize_sql
+
+
+def test_normalize_sql_keeps_literals():
+    assert (
+        normalize_sql("SELECT  name,\n   pop FROM L1  WHERE name = 'New   York' ;")
+        == "SELECT name, pop FROM L1 WHERE name = 'New   York'"
+    )
+
+
+def test_results_are_keyed_on_layer_version_and_invalidated():
+    cache = get_query_cache()
+    layer_id = f"LTEST{uuid.uuid4().hex[:7]}"
+    result = {"status": "success", "result": "a\n1\n", "row_count": 1}
+
+    cache.set("duckdb", {layer_id: "v1"}, f"SELECT a FROM {layer_id}", 20, result)
+
+    assert (
+        cache.get("duckdb", {layer_id: "v1"}, f"SELECT  a\nFROM {layer_id};", 20)
+        == result
+    )
+    # a new layer version or row cap is a different query
+    assert (
+        cache.get("duckdb", {layer_id: "v2"}, f"SELECT a FROM {layer_id}", 20) is None
+    )
+    assert (
+        cache.get("duckdb", {layer_id: "v1"}, f"SELECT a FROM {layer_id}", 50) is None
+    )
+
+    cache.invalidate(layer_id)
+    assert (
+        cache.get("duckdb", {layer_id: "v1"}, f"SELECT a FROM {layer_id}", 20) is None
+    )
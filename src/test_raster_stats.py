@@ -0,0 +1,87 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from osgeo import gdal
+
+from src.raster_stats import HISTOGRAM_BUCKETS, compute_raster_stats, stats_metadata
+
+
+def _write_raster(path, bands):
+    height, width = bands[0].shape
+    ds = gdal.GetDriverByName("GTiff").Create(
+        str(path), width, height, len(bands), gdal.GDT_Float32
+    )
+    ds.SetGeoTransform((0, 1, 0, 0, 0, -1))
+    for index, values in enumerate(bands, 1):
+        ds.GetRasterBand(index).WriteArray(values)
+    ds = None
+
+
+def test_stats_and_histograms_for_every_band(tmp_path):
+    path = tmp_path / "rgb.tif"
+    _write_raster(
+        path,
+        [
+            np.arange(100, dtype=np.float32).reshape(10, 10),
+            np.full((10, 10), 7, dtype=np.float32),
+            np.linspace(-5, 5, 100, dtype=np.float32).reshape(10, 10),
+        ],
+    )
+
+    stats = compute_raster_stats(str(path))
+
+    assert stats["approximate"] is False
+    assert [(b["min"], b["max"]) for b in stats["bands"]] == [
+        (0.0, 99.0),
+        (7.0, 7.0),
+        (-5.0, 5.0),
+    ]
+    histogram = stats["bands"][0]["histogram"]
+    assert len(histogram["counts"]) == HISTOGRAM_BUCKETS
+    assert sum(histogram["counts"]) == 100
+    assert histogram["counts"][-1] > 0  # the band max is counted
+
+    # a constant band gets a single bucket holding every pixel
+    assert stats["bands"][1]["histogram"] == {
+        "min": 7.0,
+        "max": 7.0,
+        "counts": [100],
+    }
+
+    # only single band rasters get a color ramp range
+    assert "raster_value_stats_b1" not in stats_metadata(stats)
+
+
+def test_single_band_keeps_raster_value_stats_b1(tmp_path):
+    path = tmp_path / "dem.tif"
+    _write_raster(path, [np.linspace(963, 2443, 400, dtype=np.float32).reshape(20, 20)])
+
+    metadata = stats_metadata(compute_raster_stats(str(path), approx=True))
+
+    assert metadata["raster_stats"]["approximate"] is True
+    assert metadata["raster_value_stats_b1"] == {"min": 963.0, "max": 2443.0}
+
+
+def test_constant_band_does_not_fail(tmp_path):
+    path = tmp_path / "flat.tif"
+    _write_raster(path, [np.zeros((10, 10), dtype=np.float32)])
+
+    stats = compute_raster_stats(str(path))
+
+    band = stats["bands"][0]
+    assert (band["min"], band["max"]) == (0.0, 0.0)
+    assert band["histogram"]["counts"] == [100]
+    assert stats_metadata(stats)["raster_value_stats_b1"] == {"min": 0.0, "max": 0.0}
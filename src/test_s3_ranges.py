@@ -0,0 +1,190 @@
+# Copyright (C) 2025 Bunting Labs, Inc.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+from fastapi import Request
+
+from src import s3_ranges
+from src.fs_lru import BlockCache
+from src.s3_ranges import (
+    MAX_RANGES,
+    CoalescingRangeReader,
+    RangeNotSatisfiable,
+    S3ObjectChanged,
+    coalesce_ranges,
+    parse_range_header,
+    read_cached_range,
+    serve_s3_object,
+)
+
+
+def test_parse_range_header():
+    assert parse_range_header("bytes=0-99", 1000) == [(0, 99)]
+    assert parse_range_header("bytes=900-", 1000) == [(900, 999)]
+    assert parse_range_header("bytes=-100", 1000) == [(900, 999)]
+    assert parse_range_header("bytes=0-1, 10-2000", 1000) == [(0, 1), (10, 999)]
+    # ranges past the end are dropped, malformed headers are ignored
+    assert parse_range_header("bytes=0-1,5000-", 1000) == [(0, 1)]
+    assert parse_range_header("items=0-1", 1000) is None
+    assert parse_range_header("bytes=5-1", 1000) is None
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range_header("bytes=1000-", 1000)
+
+
+def test_parse_range_header_merges_and_caps_ranges():
+    # overlapping and adjacent ranges come back merged and in order
+    assert parse_range_header("bytes=50-99,0-9,5-19,20-29", 1000) == [
+        (0, 29),
+        (50, 99),
+    ]
+    # repeated or heavily overlapping ranges fall back to the whole object
+    assert parse_range_header("bytes=0-,0-,0-", 1000) is None
+    assert parse_range_header("bytes=0-599,400-999", 1000) is None
+    # so do requests with too many ranges
+    many = ",".join(f"{i * 10}-{i * 10 + 1}" for i in range(MAX_RANGES + 1))
+    assert parse_range_header(f"bytes={many}", 1000) is None
+    fewer = many.rsplit(",", 1)[0]
+    assert len(parse_range_header(f"bytes={fewer}", 1000)) == MAX_RANGES
+
+
+@pytest.mark.anyio
+async def test_amplifying_range_request_gets_one_full_response(monkeypatch):
+    async def fake_head(bucket_name, key):
+        return 1000, '"v1"'
+
+    monkeypatch.setattr(s3_ranges.s3_head_cache, "get", fake_head)
+    request = Request(
+        {
+            "type": "http",
+            "method": "GET",
+            "path": "/",
+            "headers": [(b"range", b"bytes=" + b",".join([b"0-"] * 100))],
+        }
+    )
+
+    response = await serve_s3_object(
+        request, "bucket", "key", "application/octet-stream"
+    )
+    assert response.status_code == 200
+    assert response.headers["content-length"] == "1000"
+
+
+def test_coalesce_ranges():
+    assert coalesce_ranges([(100, 199), (0, 49), (60, 80)], max_gap=16) == [
+        (0, 80),
+        (100, 199),
+    ]
+    assert coalesce_ranges([(0, 9), (10, 19)], max_gap=0, max_span=15) == [
+        (0, 9),
+        (10, 19),
+    ]
+
+
+class FakeBody:
+    def __init__(self, data):
+        self.data = data
+
+    async def read(self, n=-1):
+        return self.data
+
+    def close(self):
+        pass
+
+
+class FakeS3:
+    def __init__(self, data):
+        self.data = data
+        self.gets = []
+
+    async def get_object(self, Bucket, Key, Range):
+        start, end = map(int, Range.removeprefix("bytes=").split("-"))
+        self.gets.append((start, end))
+        return {"Body": FakeBody(self.data[start : end + 1])}
+
+
+@pytest.mark.anyio
+async def test_nearby_reads_share_one_get(monkeypatch):
+    s3 = FakeS3(bytes(range(256)) * 64)
+
+    async def fake_client():
+        return s3
+
+    monkeypatch.setattr(s3_ranges, "get_async_s3_client", fake_client)
+    reader = CoalescingRangeReader(window=0.01, max_gap=100, max_span=1 << 20)
+
+    results = await asyncio.gather(
+        reader.read("bucket", "key", 0, 9),
+        reader.read("bucket", "key", 50, 59),
+        reader.read("bucket", "key", 10000, 10003),
+    )
+    assert results == [s3.data[0:10], s3.data[50:60], s3.data[10000:10004]]
+    assert sorted(s3.gets) == [(0, 59), (10000, 10003)]
+
+
+class VersionedFakeS3(FakeS3):
+    def __init__(self, data, etag):
+        super().__init__(data)
+        self.etag = etag
+        self.if_match = []
+
+    async def get_object(self, Bucket, Key, Range, IfMatch=None):
+        self.if_match.append(IfMatch)
+        if IfMatch is not None and IfMatch != self.etag:
+            raise ClientError(
+                {
+                    "Error": {"Code": "PreconditionFailed"},
+                    "ResponseMetadata": {"HTTPStatusCode": 412},
+                },
+                "GetObject",
+            )
+        return await super().get_object(Bucket, Key, Range)
+
+
+@pytest.mark.anyio
+async def test_overwritten_object_is_never_mixed_into_cached_blocks(
+    tmp_path, monkeypatch
+):
+    s3 = VersionedFakeS3(b"a" * 4096, '"v1"')
+
+    async def fake_client():
+        return s3
+
+    monkeypatch.setattr(s3_ranges, "get_async_s3_client", fake_client)
+    monkeypatch.setenv("RANGE_CACHE_BLOCK_BYTES", "1024")
+    monkeypatch.setenv("RANGE_CACHE_DIR", str(tmp_path))
+    cache = BlockCache()
+    monkeypatch.setattr(s3_ranges, "block_cache", lambda: cache)
+    s3_ranges.s3_head_cache._entries[("bucket", "key")] = (
+        time.monotonic() + 60,
+        4096,
+        '"v1"',
+    )
+
+    assert await read_cached_range("bucket", "key", '"v1"', 4096, 0, 99) == b"a" * 100
+    assert s3.if_match == ['"v1"']
+
+    # overwritten between the HEAD and the next block fetch
+    s3.data, s3.etag = b"b" * 4096, '"v2"'
+    with pytest.raises(S3ObjectChanged):
+        await read_cached_range("bucket", "key", '"v1"', 4096, 0, 2047)
+
+    # the stale size/ETag and every block of the old version are dropped
+    assert ("bucket", "key") not in s3_ranges.s3_head_cache._entries
+    assert cache.memory_cache.probation_total + cache.memory_cache.protected_total == 0
+    assert cache.file_cache.index.total_size() == 0